@@ -0,0 +1,424 @@
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import tempfile
+import optparse
+import subprocess
+
+# some file descriptors
+ERROR_FILE = sys.stderr
+OUTPUT_FILE = sys.stdout
+
+SCRIPTS_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+SCRIPT_NAMES = [
+	'clinical_cleanup', 'filter_study_by_subset', 'split_data_clinical_attributes',
+	'insert_clinical_metadata', 'insert_sequenced_samples', 'fmi_xml_processor'
+]
+
+# synthetic study layout - study files go in STUDY_DIRECTORY, everything else in RESOURCES_DIRECTORY
+STUDY_DIRECTORY = 'study'
+RESOURCES_DIRECTORY = 'resources'
+FMI_DIRECTORY = 'fmi'
+CLINICAL_MAP_FILENAME = 'clinical_data_map.txt'
+ATTRIBUTE_METADATA_FILENAME = 'clinical_attributes_metadata.txt'
+SUBSET_FILENAME = 'subset_samples.txt'
+FMI_FILENAME = 'fmi_variant_reports.xml'
+FMI_NAMESPACE = 'http://foundationmedicine.com/compbio/variant-report-external'
+
+# XML backends of the FMI XML processor - speedups are reported relative to the pure Python ElementTree backend
+FMI_XML_BACKENDS = ['celementtree', 'lxml', 'elementtree']
+FMI_REFERENCE_XML_BACKEND = 'elementtree'
+
+CANCER_TYPES = ['LUAD', 'LUSC', 'BRCA', 'COAD', 'PRAD', 'SKCM', 'GBM', 'PAAD']
+SEX_VALUES = ['M', 'F', 'Male', 'Female', 'male', 'female', '', 'N/A']
+SAMPLE_TYPES = ['Primary', 'Metastasis', 'primary', 'metastasis', '']
+CHROMOSOMES = [str(i) for i in range(1, 23)] + ['X']
+GENES = ['TP53', 'KRAS', 'EGFR', 'PIK3CA', 'BRAF', 'PTEN', 'APC', 'CDKN2A', 'ERBB2', 'MYC']
+
+
+def write_rows(filename, header, rows, comments = None):
+	""" Writes tab-delimited rows to the file. """
+	output_file = open(filename, 'w')
+	if comments:
+		output_file.write('\n'.join(comments) + '\n')
+	output_file.write('\t'.join(header))
+	for row in rows:
+		output_file.write('\n' + '\t'.join(row))
+	output_file.close()
+
+
+def generate_clinical_files(study_directory, resources_directory, sample_ids, rand):
+	""" Writes the clinical data files, the clinical data map and the clinical attribute metadata. """
+	clinical_header = ['SAMPLE_ID', 'PATIENT_ID', 'CANCER_TYPE', 'SEX', 'AGE', 'SAMPLE_TYPE', 'SMOKING', 'OS_MONTHS', 'EMPTY_ATTRIBUTE']
+	clinical_rows = []
+	for sample_id in sample_ids:
+		patient_id = 'P-' + sample_id.split('-')[1]
+		clinical_rows.append([
+			sample_id, patient_id, rand.choice(CANCER_TYPES), rand.choice(SEX_VALUES),
+			str(rand.randint(18, 90)), rand.choice(SAMPLE_TYPES), rand.choice(['Yes', 'No', ' yes ', 'NA']),
+			'%.1f' % rand.uniform(0, 120), ''
+		])
+	write_rows(os.path.join(study_directory, 'data_clinical.txt'), clinical_header, clinical_rows)
+
+	sample_header = ['SAMPLE_ID', 'PATIENT_ID', 'CANCER_TYPE', 'SAMPLE_TYPE']
+	write_rows(os.path.join(study_directory, 'data_clinical_sample.txt'), sample_header, [[r[0], r[1], r[2], r[5]] for r in clinical_rows])
+
+	patients = {}
+	for r in clinical_rows:
+		patients.setdefault(r[1], [r[1], r[3], r[4], r[6], r[7]])
+	patient_header = ['PATIENT_ID', 'SEX', 'AGE', 'SMOKING', 'OS_MONTHS']
+	write_rows(os.path.join(study_directory, 'data_clinical_patient.txt'), patient_header, [patients[p] for p in sorted(patients.keys())])
+
+	# clinical data map covering every processing type used by clinical_cleanup
+	map_rows = [['KEEP_ALL', attr, '', attr, ''] for attr in ['SAMPLE_ID', 'PATIENT_ID', 'AGE', 'OS_MONTHS']]
+	map_rows.extend([['FIX_ATTRIBUTE', 'CANCER_TYPE', code, 'ONCOTREE_CODE', code] for code in CANCER_TYPES])
+	map_rows.extend([['FIX_VALUE', 'SEX', val, 'SEX', norm] for val,norm in [('M', 'Male'), ('F', 'Female'), ('Male', 'Male'), ('Female', 'Female'), ('male', 'Male'), ('female', 'Female')]])
+	for val in SAMPLE_TYPES:
+		if val:
+			map_rows.append(['FIX_ALL', 'SAMPLE_TYPE', val, 'SAMPLE_CLASS', val.capitalize()])
+	map_rows.extend([['MERGE', 'SMOKING', val, 'SMOKING_HISTORY', norm] for val,norm in [('Yes', 'Smoker'), ('No', 'Never'), ('yes', 'Smoker'), ('NA', 'None')]])
+	map_rows.append(['ADD_ALL', '', '', 'CENTER', 'SYNTHETIC'])
+	map_rows.append(['IGNORE', 'EMPTY_ATTRIBUTE', '', '', ''])
+	map_header = ['PROCESSING_TYPE', 'ORIGINAL_ATTRIBUTE', 'ORIGINAL_VALUE', 'NORMALIZED_ATTRIBUTE', 'NORMALIZED_VALUE']
+	write_rows(os.path.join(resources_directory, CLINICAL_MAP_FILENAME), map_header, map_rows)
+
+	metadata_header = ['NORMALIZED_COLUMN_HEADER', 'ATTRIBUTE_TYPE', 'DISPLAY_NAME', 'DESCRIPTIONS', 'PRIORITY', 'DATATYPE']
+	patient_attributes = ['PATIENT_ID', 'SEX', 'AGE', 'SMOKING', 'OS_MONTHS']
+	metadata_rows = []
+	for attr in clinical_header:
+		attribute_type = 'PATIENT' if attr in patient_attributes else 'SAMPLE'
+		datatype = 'NUMBER' if attr in ['AGE', 'OS_MONTHS'] else 'STRING'
+		metadata_rows.append([attr, attribute_type, attr.replace('_', ' ').title(), attr.replace('_', ' ').lower(), '1', datatype])
+	write_rows(os.path.join(resources_directory, ATTRIBUTE_METADATA_FILENAME), metadata_header, metadata_rows)
+
+
+def generate_mutation_file(study_directory, sample_ids, mutations_per_sample, rand):
+	""" Writes the MAF with a random number of mutations per sample. """
+	maf_header = ['Hugo_Symbol', 'Entrez_Gene_Id', 'Tumor_Sample_Barcode', 'Chromosome', 'Start_Position', 'End_Position', 'Variant_Classification', 'Reference_Allele', 'Tumor_Seq_Allele2']
+	maf_rows = []
+	for sample_id in sample_ids:
+		for i in range(rand.randint(0, 2 * mutations_per_sample)):
+			position = rand.randint(1, 100000000)
+			maf_rows.append([rand.choice(GENES), '0', sample_id, rand.choice(CHROMOSOMES), str(position), str(position), 'Missense_Mutation', 'A', 'T'])
+	write_rows(os.path.join(study_directory, 'data_mutations_extended.txt'), maf_header, maf_rows, ['#version 2.4'])
+	return len(maf_rows)
+
+
+def generate_profile_files(study_directory, sample_ids, num_genes, rand):
+	""" Writes the CNA and expression matrices. """
+	header = ['Hugo_Symbol', 'Entrez_Gene_Id'] + sample_ids
+	genes = ['GENE%d' % i for i in range(num_genes)]
+	write_rows(os.path.join(study_directory, 'data_CNA.txt'), header,
+		([gene, str(i)] + [str(rand.choice([-2, -1, 0, 0, 0, 1, 2])) for s in sample_ids] for i,gene in enumerate(genes)))
+	write_rows(os.path.join(study_directory, 'data_RNA_Seq_expression_median.txt'), header,
+		([gene, str(i)] + ['%.4f' % rand.gauss(0, 1) for s in sample_ids] for i,gene in enumerate(genes)))
+
+
+def generate_segment_file(study_directory, sample_ids, segments_per_sample, rand):
+	""" Writes the .seg file. """
+	seg_header = ['ID', 'chrom', 'loc.start', 'loc.end', 'num.mark', 'seg.mean']
+	seg_rows = []
+	for sample_id in sample_ids:
+		for chrom in CHROMOSOMES[:max(1, segments_per_sample // 4)]:
+			start = 1
+			for i in range(4):
+				end = start + rand.randint(100000, 10000000)
+				seg_rows.append([sample_id, chrom, str(start), str(end), str(rand.randint(10, 1000)), '%.4f' % rand.gauss(0, 0.5)])
+				start = end + 1
+	write_rows(os.path.join(study_directory, 'synthetic_data_cna_hg19.seg'), seg_header, seg_rows)
+	return len(seg_rows)
+
+
+def generate_fmi_file(fmi_directory, num_cases, rand):
+	""" Writes a multi-case FoundationOne XML file. """
+	fmi_file = open(os.path.join(fmi_directory, FMI_FILENAME), 'w')
+	fmi_file.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+	fmi_file.write('<ResultsReport xmlns="%s">\n' % FMI_NAMESPACE)
+	for i in range(num_cases):
+		case = 'TRF%06d' % i
+		fmi_file.write('<variant-report disease="%s" specimen="%s" gender="%s">\n' % (rand.choice(CANCER_TYPES), case, rand.choice(['male', 'female'])))
+		fmi_file.write('<samples><sample name="%s" nucleic-acid-type="DNA" /></samples>\n' % case)
+		fmi_file.write('<short-variants>\n')
+		for j in range(rand.randint(1, 20)):
+			depth = '' if rand.random() < 0.3 else ' depth="%d"' % rand.randint(100, 1000)
+			fmi_file.write('<short-variant gene="%s" cds-effect="c.%dA&gt;T" status="known"%s />\n' % (rand.choice(GENES), rand.randint(1, 3000), depth))
+		fmi_file.write('</short-variants>\n')
+		fmi_file.write('<copy-number-alterations><copy-number-alteration gene="%s" type="amplification" copy-number="%d" /></copy-number-alterations>\n' % (rand.choice(GENES), rand.randint(5, 30)))
+		fmi_file.write('<rearrangements />\n')
+		fmi_file.write('</variant-report>\n')
+	fmi_file.write('</ResultsReport>\n')
+	fmi_file.close()
+
+
+def generate_synthetic_study(root_directory, num_samples, num_genes, mutations_per_sample, segments_per_sample, num_fmi_cases, seed):
+	""" Generates a synthetic cBioPortal study and returns the number of rows in each of its data files. """
+	rand = random.Random(seed)
+	study_directory = os.path.join(root_directory, STUDY_DIRECTORY)
+	resources_directory = os.path.join(root_directory, RESOURCES_DIRECTORY)
+	fmi_directory = os.path.join(root_directory, FMI_DIRECTORY)
+	for directory in [study_directory, resources_directory, fmi_directory]:
+		os.makedirs(directory)
+
+	sample_ids = ['S-%07d-T01' % i for i in range(num_samples)]
+	generate_clinical_files(study_directory, resources_directory, sample_ids, rand)
+	num_mutations = generate_mutation_file(study_directory, sample_ids, mutations_per_sample, rand)
+	generate_profile_files(study_directory, sample_ids, num_genes, rand)
+	num_segments = generate_segment_file(study_directory, sample_ids, segments_per_sample, rand)
+	generate_fmi_file(fmi_directory, num_fmi_cases, rand)
+
+	# every tenth sample goes in the subset
+	subset_file = open(os.path.join(resources_directory, SUBSET_FILENAME), 'w')
+	subset_file.write('\n'.join(sample_ids[::10]))
+	subset_file.close()
+
+	return {'samples':num_samples, 'mutations':num_mutations, 'genes':num_genes, 'segments':num_segments, 'fmi_cases':num_fmi_cases}
+
+
+def get_script_command(script_name, work_directory, python, xml_backend = None):
+	""" Returns the command line and working directory for running the script against the synthetic study. """
+	study_directory = os.path.join(work_directory, STUDY_DIRECTORY)
+	resources_directory = os.path.join(work_directory, RESOURCES_DIRECTORY)
+	script = os.path.join(SCRIPTS_DIRECTORY, script_name + '.py')
+
+	if script_name == 'clinical_cleanup':
+		args = ['--clinical-file', os.path.join(study_directory, 'data_clinical.txt'), '--output-directory', study_directory,
+			'--map-file', os.path.join(resources_directory, CLINICAL_MAP_FILENAME), '--genomic-alterations', 'true']
+	elif script_name == 'filter_study_by_subset':
+		args = ['--subset-file', os.path.join(resources_directory, SUBSET_FILENAME), '--subset-identifier', 'benchmark', '--input-directory', study_directory]
+	elif script_name == 'split_data_clinical_attributes':
+		args = ['--clinical-file', os.path.join(study_directory, 'data_clinical.txt'), '--metadata-file', os.path.join(resources_directory, ATTRIBUTE_METADATA_FILENAME)]
+	elif script_name == 'insert_clinical_metadata':
+		args = ['--directory', study_directory, '--metadata-file', os.path.join(resources_directory, ATTRIBUTE_METADATA_FILENAME)]
+	elif script_name == 'insert_sequenced_samples':
+		args = ['--source-file', os.path.join(study_directory, 'data_clinical.txt'), '--maf-file', os.path.join(study_directory, 'data_mutations_extended.txt')]
+	elif script_name == 'fmi_xml_processor':
+		args = ['--filename', os.path.join(work_directory, FMI_DIRECTORY, FMI_FILENAME), '--output_directory', os.path.join(work_directory, 'fmi_output')]
+		if xml_backend != None:
+			args += ['--xml-backend', xml_backend]
+	return [python, script] + args, work_directory
+
+
+def get_script_rows(script_name, study_counts):
+	""" Returns the number of input rows the script processes, used for the rows/sec rate. """
+	if script_name in ['clinical_cleanup', 'split_data_clinical_attributes']:
+		return study_counts['samples']
+	elif script_name == 'insert_clinical_metadata':
+		return 3 * study_counts['samples']
+	elif script_name == 'insert_sequenced_samples':
+		return study_counts['mutations']
+	elif script_name == 'filter_study_by_subset':
+		return 3 * study_counts['samples'] + study_counts['mutations'] + 2 * study_counts['genes'] + study_counts['segments']
+	elif script_name == 'fmi_xml_processor':
+		return study_counts['fmi_cases']
+
+
+def run_script(command, cwd, log_filename):
+	"""
+		Runs the script and returns (exit code, wall time in seconds, peak RSS in KB).
+		The child is reaped with os.wait4 so that the peak RSS is for this run only.
+	"""
+	log_file = open(log_filename, 'w')
+	start_time = time.time()
+	process = subprocess.Popen(command, cwd = cwd, stdout = log_file, stderr = subprocess.STDOUT)
+	pid,status,rusage = os.wait4(process.pid, 0)
+	wall_time = time.time() - start_time
+	log_file.close()
+	return os.WEXITSTATUS(status), wall_time, rusage.ru_maxrss
+
+
+def benchmark_script(script_name, study_directory, study_counts, repeat, python, xml_backend = None):
+	"""
+		Runs the script against fresh copies of the synthetic study and returns its timings.
+		Runs with an XML backend are reported as script[backend].
+	"""
+	name = script_name
+	if xml_backend != None:
+		name = '%s[%s]' % (script_name, xml_backend)
+
+	runs = []
+	for i in range(repeat):
+		work_directory = tempfile.mkdtemp(prefix = name + '.', dir = study_directory)
+		for directory in [STUDY_DIRECTORY, RESOURCES_DIRECTORY, FMI_DIRECTORY]:
+			shutil.copytree(os.path.join(study_directory, directory), os.path.join(work_directory, directory))
+
+		command,cwd = get_script_command(script_name, work_directory, python, xml_backend)
+		log_filename = os.path.join(study_directory, '%s.%d.log' % (name, i))
+		metrics_filename = os.path.join(study_directory, '%s.%d.metrics.json' % (name, i))
+		exit_code,wall_time,peak_rss = run_script(command + ['--metrics-json', metrics_filename], cwd, log_filename)
+		shutil.rmtree(work_directory)
+		if exit_code != 0:
+			print 'ERROR:', name, 'exited with code', exit_code, '- see log:', log_filename
+			return {'script':name, 'status':'failed', 'exit_code':exit_code, 'log':log_filename}
+
+		metrics_file = open(metrics_filename, 'rU')
+		stages = json.load(metrics_file)['stages']
+		metrics_file.close()
+		runs.append((wall_time, peak_rss, stages))
+
+	# report the fastest run, which is the least affected by noise from other processes
+	wall_time,peak_rss,stages = min(runs)
+	peak_rss = max([run[1] for run in runs])
+	rows = get_script_rows(script_name, study_counts)
+	return {
+		'script':name,
+		'status':'ok',
+		'wall_time':wall_time,
+		'rows':rows,
+		'rows_per_sec':rows / wall_time if wall_time > 0 else 0.0,
+		'peak_rss_kb':peak_rss,
+		'stages':stages
+	}
+
+
+def add_xml_backend_speedups(results):
+	""" Adds the speedup of each FMI XML backend over the reference backend, or over the slowest backend if it was not run. """
+	backend_results = [result for result in results if result['script'].startswith('fmi_xml_processor[') and result['status'] == 'ok']
+	if len(backend_results) < 2:
+		return
+	reference = max(backend_results, key = lambda result: result['wall_time'])
+	for result in backend_results:
+		if result['script'] == 'fmi_xml_processor[%s]' % FMI_REFERENCE_XML_BACKEND:
+			reference = result
+	for result in backend_results:
+		result['speedup_over'] = reference['script']
+		result['speedup'] = reference['wall_time'] / result['wall_time'] if result['wall_time'] > 0 else 0.0
+
+
+def compare_to_baseline(results, baseline_filename, max_slowdown):
+	""" Returns the scripts that are slower than in the baseline results by more than the allowed factor. """
+	baseline_file = open(baseline_filename, 'rU')
+	baseline = dict([(r['script'], r) for r in json.load(baseline_file)['results']])
+	baseline_file.close()
+
+	regressions = []
+	for result in results:
+		previous = baseline.get(result['script'])
+		if result['status'] != 'ok' or previous == None or previous.get('status') != 'ok':
+			continue
+		slowdown = result['wall_time'] / previous['wall_time']
+		result['baseline_wall_time'] = previous['wall_time']
+		result['slowdown'] = slowdown
+		if slowdown > max_slowdown:
+			regressions.append(result['script'])
+	return regressions
+
+
+def print_results(results):
+	""" Prints the benchmark results as a table. """
+	print
+	print '%-32s %8s %12s %14s %14s' % ('SCRIPT', 'STATUS', 'WALL (s)', 'ROWS/SEC', 'PEAK RSS (MB)')
+	for result in results:
+		if result['status'] != 'ok':
+			print '%-32s %8s' % (result['script'], result['status'])
+			continue
+		line = '%-32s %8s %12.3f %14.1f %14.1f' % (result['script'], result['status'], result['wall_time'], result['rows_per_sec'], result['peak_rss_kb'] / 1024.0)
+		if 'slowdown' in result:
+			line += '  (%.2fx baseline)' % result['slowdown']
+		if 'speedup' in result:
+			line += '  (%.2fx speedup over %s)' % (result['speedup'], result['speedup_over'])
+		print line
+		for stage in result['stages']:
+			print '    %-28s %8s %12.3f' % (stage['name'], '', stage['wall_time'])
+	print
+
+
+def usage():
+	print >> OUTPUT_FILE, 'benchmark_curation_scripts.py [--num-samples N] [--num-genes N] [--mutations-per-sample N] [--segments-per-sample N] [--fmi-cases N] [--repeat N] [--scripts script1,script2] [--work-directory path/to/work/directory] [--keep] [--output-json path/to/results.json] [--baseline path/to/baseline.json] [--max-slowdown X] [--xml-backends celementtree,lxml,elementtree]'
+
+
+def main():
+	# get command line arguments
+	parser = optparse.OptionParser()
+	parser.add_option('-n', '--num-samples', action = 'store', dest = 'numsamples', type = 'int', default = 1000)
+	parser.add_option('-g', '--num-genes', action = 'store', dest = 'numgenes', type = 'int', default = 500)
+	parser.add_option('-m', '--mutations-per-sample', action = 'store', dest = 'mutations', type = 'int', default = 10)
+	parser.add_option('-e', '--segments-per-sample', action = 'store', dest = 'segments', type = 'int', default = 40)
+	parser.add_option('-x', '--fmi-cases', action = 'store', dest = 'fmicases', type = 'int', default = 200)
+	parser.add_option('-r', '--repeat', action = 'store', dest = 'repeat', type = 'int', default = 1)
+	parser.add_option('-s', '--scripts', action = 'store', dest = 'scripts', default = ','.join(SCRIPT_NAMES))
+	parser.add_option('-w', '--work-directory', action = 'store', dest = 'workdir')
+	parser.add_option('-k', '--keep', action = 'store_true', dest = 'keep', default = False)
+	parser.add_option('-o', '--output-json', action = 'store', dest = 'outputjson')
+	parser.add_option('-b', '--baseline', action = 'store', dest = 'baseline')
+	parser.add_option('-t', '--max-slowdown', action = 'store', dest = 'maxslowdown', type = 'float', default = 1.25)
+	parser.add_option('-p', '--python', action = 'store', dest = 'python', default = sys.executable)
+	parser.add_option('-l', '--xml-backends', action = 'store', dest = 'xmlbackends')
+	parser.add_option('--seed', action = 'store', dest = 'seed', type = 'int', default = 0)
+
+	(options, args) = parser.parse_args()
+
+	script_names = [name.strip() for name in options.scripts.split(',') if name.strip()]
+	for script_name in script_names:
+		if script_name not in SCRIPT_NAMES:
+			print 'ERROR: Unknown script:', script_name
+			usage()
+			sys.exit(2)
+
+	# the FMI XML processor is run once with each XML backend, or with the fastest installed one if none are given
+	xml_backends = [None]
+	if options.xmlbackends != None:
+		xml_backends = [backend.strip() for backend in options.xmlbackends.split(',') if backend.strip()]
+		for xml_backend in xml_backends:
+			if xml_backend not in FMI_XML_BACKENDS:
+				print 'ERROR: Unknown XML backend:', xml_backend
+				usage()
+				sys.exit(2)
+
+	if options.baseline != None and not os.path.exists(options.baseline):
+		print 'No such file:', options.baseline
+		sys.exit(2)
+
+	if options.workdir == None:
+		work_directory = tempfile.mkdtemp(prefix = 'curation_benchmark.')
+	elif os.path.exists(options.workdir):
+		print 'ERROR: Work directory already exists:', options.workdir
+		sys.exit(2)
+	else:
+		work_directory = options.workdir
+		os.makedirs(work_directory)
+
+	print 'Generating synthetic study in:', work_directory
+	study_counts = generate_synthetic_study(work_directory, options.numsamples, options.numgenes, options.mutations, options.segments, options.fmicases, options.seed)
+	print 'Synthetic study:', ', '.join(['%s=%d' % (k, v) for k,v in sorted(study_counts.items())])
+
+	results = []
+	for script_name in script_names:
+		if script_name != 'fmi_xml_processor':
+			print 'Benchmarking:', script_name
+			results.append(benchmark_script(script_name, work_directory, study_counts, options.repeat, options.python))
+			continue
+		for xml_backend in xml_backends:
+			print 'Benchmarking:', script_name, 'with XML backend:', xml_backend or 'auto'
+			results.append(benchmark_script(script_name, work_directory, study_counts, options.repeat, options.python, xml_backend))
+	add_xml_backend_speedups(results)
+
+	regressions = []
+	if options.baseline != None:
+		regressions = compare_to_baseline(results, options.baseline, options.maxslowdown)
+	print_results(results)
+
+	if options.outputjson != None:
+		output_file = open(options.outputjson, 'w')
+		json.dump({'study':study_counts, 'results':results}, output_file, indent = 2, sort_keys = True)
+		output_file.close()
+		print 'Benchmark results written to:', options.outputjson
+
+	failed = [result['script'] for result in results if result['status'] != 'ok']
+	if options.keep or failed:
+		print 'Synthetic study and logs kept in:', work_directory
+	else:
+		shutil.rmtree(work_directory)
+
+	if failed:
+		print 'ERROR: Scripts failed:', ', '.join(failed)
+		sys.exit(1)
+	if regressions:
+		print 'ERROR: Performance regressions (more than %.2fx slower than baseline):' % options.maxslowdown, ', '.join(regressions)
+		sys.exit(1)
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,192 @@
+import os
+import sys
+import optparse
+
+import curation_io
+import curation_metrics
+
+# some file descriptors
+ERROR_FILE = sys.stderr
+OUTPUT_FILE = sys.stdout
+
+# sidecar index written next to each row-oriented data file
+INDEX_EXTENSION = '.cidx'
+INDEX_VERSION = '1'
+
+# case id column of each row-oriented data file
+ROW_FILE_CASE_ID_COLUMNS = {
+	'data_clinical.txt':'SAMPLE_ID',
+	'data_clinical_patient.txt':'PATIENT_ID',
+	'data_clinical_sample.txt':'SAMPLE_ID',
+	'data_mutations_extended.txt':'Tumor_Sample_Barcode'
+}
+SEG_FILE_CASE_ID_COLUMN = 'ID'
+TIMELINE_FILE_PREFIX = 'data_timeline'
+TIMELINE_FILE_CASE_ID_COLUMN = 'PATIENT_ID'
+
+
+def get_case_id_column(filename):
+	""" Returns the case id column for the data file, or None if it is not a row-oriented data file. """
+	basename = os.path.basename(filename)
+	if basename.endswith('.seg'):
+		return SEG_FILE_CASE_ID_COLUMN
+	elif basename.startswith(TIMELINE_FILE_PREFIX) and basename.endswith('.txt'):
+		return TIMELINE_FILE_CASE_ID_COLUMN
+	return ROW_FILE_CASE_ID_COLUMNS.get(basename)
+
+
+def build_case_id_index(filename, column):
+	"""
+		Scans the data file once and writes the byte ranges of the rows of each case id to the sidecar index.
+		Consecutive rows of the same case id are stored as a single range.
+	"""
+	case_id_ranges = {}
+	case_id_order = []
+	column_index = None
+	data_start = None
+
+	data_file = open(filename, 'rb')
+	offset = 0
+	for line in data_file:
+		line_start = offset
+		offset += len(line)
+
+		# skip commented lines and find the case id column in the header
+		if line.startswith('#'):
+			continue
+		if column_index == None:
+			header = [hdr.strip() for hdr in line.split('\t')]
+			if column not in header:
+				data_file.close()
+				print 'ERROR: Could not find case id column', column, 'in file:', filename
+				return None
+			column_index = header.index(column)
+			data_start = offset
+			continue
+		if not line.rstrip('\r\n'):
+			continue
+
+		line_data = line.rstrip('\r\n').split('\t', column_index + 1)
+		case_id = line_data[column_index].strip() if len(line_data) > column_index else ''
+		ranges = case_id_ranges.get(case_id)
+		if ranges == None:
+			case_id_ranges[case_id] = [[line_start, offset - line_start]]
+			case_id_order.append(case_id)
+		elif ranges[-1][0] + ranges[-1][1] == line_start:
+			ranges[-1][1] += offset - line_start
+		else:
+			ranges.append([line_start, offset - line_start])
+	data_file.close()
+
+	if column_index == None:
+		print 'ERROR: No header found in file:', filename
+		return None
+
+	size,mtime = curation_io.get_file_signature(filename)
+	index_filename = filename + INDEX_EXTENSION
+	temp_index_filename = index_filename + '.' + str(os.getpid())
+	index_file = open(temp_index_filename, 'w')
+	index_file.write('\t'.join(['#case_id_index', INDEX_VERSION, size, mtime, column, str(data_start)]))
+	for case_id in case_id_order:
+		index_file.write('\n' + case_id + '\t' + ','.join(['%d:%d' % (start, length) for start,length in case_id_ranges[case_id]]))
+	index_file.close()
+	os.rename(temp_index_filename, index_filename)
+	return index_filename
+
+
+def load_case_id_index(filename, column, case_ids = None):
+	"""
+		Returns the byte ranges of the rows of each case id from the sidecar index of the data file.
+		Only the given case ids are loaded, if any are given. Returns None if there is no index
+		or if it is out of date or was built for a different case id column.
+	"""
+	index_filename = filename + INDEX_EXTENSION
+	if not os.path.exists(index_filename):
+		return None
+
+	index_file = open(index_filename, 'rU')
+	index_info = index_file.readline().rstrip('\n').split('\t')
+	if len(index_info) != 6 or index_info[0] != '#case_id_index' or index_info[1] != INDEX_VERSION:
+		index_file.close()
+		print 'WARNING: Ignoring invalid case id index:', index_filename
+		return None
+	if tuple(index_info[2:4]) != curation_io.get_file_signature(filename) or index_info[4] != column:
+		index_file.close()
+		print 'WARNING: Ignoring out of date case id index:', index_filename
+		return None
+
+	case_id_ranges = {}
+	for line in index_file:
+		case_id,ranges = line.rstrip('\n').split('\t')
+		if case_ids == None or case_id in case_ids:
+			case_id_ranges[case_id] = [tuple(map(int, r.split(':'))) for r in ranges.split(',')]
+	index_file.close()
+	return case_id_ranges
+
+
+def read_case_id_rows(filename, case_id_ranges):
+	"""
+		Yields (case id, row) for the rows of the given case ids in file order,
+		seeking directly to the byte ranges from the case id index.
+	"""
+	ranges = []
+	for case_id,case_ranges in case_id_ranges.items():
+		ranges.extend([(start, length, case_id) for start,length in case_ranges])
+	ranges.sort()
+
+	data_file = open(filename, 'rb')
+	for start,length,case_id in ranges:
+		data_file.seek(start)
+		for line in data_file.read(length).splitlines():
+			if line:
+				yield case_id, line
+	data_file.close()
+
+
+def index_study_directory(input_directory):
+	""" Writes the case id index for every row-oriented data file in the study directory. """
+	num_indexed = 0
+	for filename in sorted(os.listdir(input_directory)):
+		filename_path = os.path.join(input_directory, filename)
+		column = get_case_id_column(filename)
+		if os.path.isdir(filename_path) or 'meta_' in filename or column == None:
+			continue
+
+		print 'Indexing file:', filename, 'using column:', column
+		with curation_metrics.stage('build_case_id_index'):
+			index_filename = build_case_id_index(filename_path, column)
+		curation_metrics.add_file_size('input_bytes', filename_path)
+		if index_filename != None:
+			print 'Case id index written to:', index_filename
+			num_indexed += 1
+			curation_metrics.add_count('indexed_files')
+	print 'Indexed', num_indexed, 'data files in:', input_directory
+
+
+def usage():
+	print >> OUTPUT_FILE, 'case_id_index.py --input-directory path/to/study/directory [--metrics-json path/to/metrics.json]'
+
+
+def main():
+	# get command line arguments
+	parser = optparse.OptionParser()
+	parser.add_option('-i', '--input-directory', action = 'store', dest = 'inputdir')
+	parser.add_option('--metrics-json', action = 'store', dest = 'metricsjson')
+
+	(options, args) = parser.parse_args()
+	curation_metrics.enable_metrics('case_id_index', options.metricsjson)
+	input_directory = options.inputdir
+
+	if input_directory == None:
+		usage()
+		sys.exit(2)
+
+	if not os.path.isdir(input_directory):
+		print 'No such directory:', input_directory
+		sys.exit(2)
+
+	index_study_directory(input_directory)
+
+
+if __name__ == '__main__':
+	main()
@@ -2,6 +2,14 @@ import sys
 import os
 import csv 
 import optparse
+import multiprocessing
+import hashlib
+import cPickle
+import json
+import gzip
+
+import curation_metrics
+import curation_io
 
 
 # some file descriptors
@@ -27,9 +35,36 @@ CLINICAL_DATA_MAP = {}
 
 CASE_ID_ATTRIBUTES = ['PATIENT_ID', 'SAMPLE_ID','OTHER_PATIENT_ID', 'OTHER_SAMPLE_ID']
 
+MAF_FILENAMES = ['data_mutations_extended.txt', 'data_mutations_extended.txt.gz', 'data_mutations_extended.txt.bgz']
+
 NORMALIZED_ATTRIBUTE_LIST = []
 POST_PROCESS_ATTRIBUTE_FILTER = []
 
+# normalized attribute -> (processing type, original attributes, value tables) compiled from CLINICAL_DATA_MAP
+NORMALIZATION_PLAN = {}
+
+# number of value fixes per column and the optional audit log for row-level value fixes
+VALUE_FIX_COUNTS = {}
+AUDIT_LOG = {'file':None, 'format':None, 'batch':[]}
+AUDIT_BATCH_SIZE = 10000
+
+# compiled clinical data map cache stored next to the map file
+MAP_CACHE_EXTENSION = '.cache'
+MAP_CACHE_VERSION = 1
+
+# sidecar manifest of row fingerprints written next to the processed clinical file in incremental mode
+MANIFEST_EXTENSION = '.manifest'
+MANIFEST_VERSION = 1
+
+# (processing type, normalized attribute, original values) -> normalized value
+NORMALIZATION_CACHE = {}
+NORMALIZATION_CACHE_SIZE = 100000
+NORMALIZATION_CACHE_STATS = {'hits':0, 'misses':0}
+
+# number of samples sent to a worker process at a time and the row plan set in each worker
+WORKER_CHUNK_SIZE = 1000
+WORKER_ROW_PLAN = None
+
 
 def get_header(filename, map_clinical_data, calc_genomic_alterations):
 	"""
@@ -46,8 +81,9 @@ def get_header(filename, map_clinical_data, calc_genomic_alterations):
 def get_file_header(filename):
 	"""
 	"""	
-	filedata = open(filename).read().split('\n')	
-	file_header = map(str.strip, filedata[0].split('\t'))
+	header_file = curation_io.open_input_file(filename)
+	file_header = map(str.strip, header_file.readline().split('\t'))
+	header_file.close()
 
 	header = [hdr for hdr in CASE_ID_ATTRIBUTES if hdr in file_header]
 	header_ext = [hdr for hdr in file_header if hdr not in header]
@@ -95,137 +131,214 @@ def process_datum(val):
 		return vfixed
 
 
-def update_attribute_counts(line_data):
+def update_attribute_counts(clin_attrs, line_data):
 	"""
 	"""
-	for k,v in line_data.items():
+	for k,v in zip(clin_attrs, line_data):
 		if v != 'NA':
 			CLIN_ATTR_COUNTS[k] = CLIN_ATTR_COUNTS.get(k, 0) + 1
 
 
-def basic_clinical_cleanup(clin_filename):
+def clean_sample_rows(clin_filename, clin_attrs, report_fixes = True):
 	"""
+		Yields (sample id, cleaned sample data) for each row in the clinical file.
+		Sample data is a list of values in the same order as the given clinical attributes.
+		Rows are read one at a time so that callers can stream the clinical data.
 	"""
-	clin_file = open(clin_filename, 'rU')
+	clin_file = curation_io.open_input_file(clin_filename)
 	clin_reader = csv.DictReader(clin_file, dialect = 'excel-tab')
-	clin_attrs = get_file_header(clin_filename)
 
-	basic_sample_data = {}
-	num_vals_changed = 0
-	oncotre_counts = 0
 	for line in clin_reader:
 		sample_id = line['SAMPLE_ID'].strip()
 		line_data = map(lambda x: process_datum(line.get(x,'NA')), clin_attrs)
-		for i,attr in enumerate(clin_attrs):
-			if line_data[i] != line.get(attr,'NA'):
-				num_vals_changed += 1
-				print 'Value fixed in column:', attr, 'for sample id', sample_id
-				print '\t', '"'+line.get(attr,'NA')+'"', '==>', '"'+line_data[i]+'"'
-		sample_data = dict(zip(clin_attrs, line_data))
-		basic_sample_data[sample_id] = sample_data
-		update_attribute_counts(sample_data)
+		if report_fixes:
+			for i,attr in enumerate(clin_attrs):
+				if line_data[i] != line.get(attr,'NA'):
+					log_value_fix(sample_id, attr, line.get(attr,'NA'), line_data[i])
+		yield sample_id, line_data
+	clin_file.close()
+
+	if report_fixes:
+		print_value_fix_summary()
+
+
+def open_audit_log(audit_filename):
+	"""
+		Opens the audit log for row-level value fixes.
+		Files ending in .jsonl get one JSON record per line, anything else is written as TSV.
+	"""
+	AUDIT_LOG['file'] = open(audit_filename, 'w')
+	if audit_filename.endswith('.jsonl'):
+		AUDIT_LOG['format'] = 'jsonl'
+	else:
+		AUDIT_LOG['format'] = 'tsv'
+		AUDIT_LOG['file'].write('\t'.join(['SAMPLE_ID', 'COLUMN', 'OLD_VALUE', 'NEW_VALUE']) + '\n')
+
+
+def decode_audit_value(value):
+	"""
+		Decodes the value for the JSON audit log.
+		Bytes that are not valid UTF-8 are replaced, so that a messy value cannot stop the cleanup.
+	"""
+	if isinstance(value, str):
+		return value.decode('utf-8', 'replace')
+	return value
+
+
+def log_value_fix(sample_id, attr, old_val, new_val):
+	"""
+		Counts a value fix for the column and adds it to the audit log batch, if the audit log is open.
+	"""
+	VALUE_FIX_COUNTS[attr] = VALUE_FIX_COUNTS.get(attr, 0) + 1
+	if AUDIT_LOG['file'] == None:
+		return
+
+	if AUDIT_LOG['format'] == 'jsonl':
+		record = json.dumps({'SAMPLE_ID':decode_audit_value(sample_id), 'COLUMN':decode_audit_value(attr),
+			'OLD_VALUE':decode_audit_value(old_val), 'NEW_VALUE':decode_audit_value(new_val)})
+	else:
+		record = '\t'.join([sample_id, attr, old_val or '', new_val])
+	AUDIT_LOG['batch'].append(record)
+	if len(AUDIT_LOG['batch']) >= AUDIT_BATCH_SIZE:
+		flush_audit_log()
+
+
+def flush_audit_log():
+	"""
+		Writes the current batch of value fixes to the audit log.
+	"""
+	if AUDIT_LOG['file'] != None and AUDIT_LOG['batch']:
+		AUDIT_LOG['file'].write('\n'.join(AUDIT_LOG['batch']) + '\n')
+		AUDIT_LOG['batch'] = []
+
+
+def close_audit_log():
+	"""
+	"""
+	if AUDIT_LOG['file'] != None:
+		flush_audit_log()
+		print 'Value fixes written to:', os.path.abspath(AUDIT_LOG['file'].name)
+		AUDIT_LOG['file'].close()
+		AUDIT_LOG['file'] = None
 
+
+def print_value_fix_summary():
+	"""
+		Prints the number of values fixed in each column.
+	"""
+	num_vals_changed = sum(VALUE_FIX_COUNTS.values())
 	if num_vals_changed == 0:
 		print 'No values were fixed.'
-	else:
-		print 'Fixed,', num_vals_changed, 'values.'
+		return
 
-	if oncotre_counts > 0:
-		print 'ONCOTREE_CODE added to', oncotre_counts, 'samples'
+	for attr in sorted(VALUE_FIX_COUNTS.keys()):
+		print 'Values fixed in column:', attr, '-', VALUE_FIX_COUNTS[attr]
+	print 'Fixed,', num_vals_changed, 'values.'
 
-	clin_file.close()
+
+def basic_clinical_cleanup(clin_filename):
+	"""
+	"""
+	clin_attrs = get_file_header(clin_filename)
+
+	basic_sample_data = {}
+	for sample_id,sample_data in clean_sample_rows(clin_filename, clin_attrs):
+		basic_sample_data[sample_id] = sample_data
+		update_attribute_counts(clin_attrs, sample_data)
 	return basic_sample_data
 
 
-def write_temp_file(filename):
+def count_clinical_attributes(clin_filename):
 	"""
+		First pass of streaming mode: only gathers the clinical attribute
+		counts used for filtering out attributes with zero counts.
 	"""
-	filedata = [x for x in open(filename).read().split('\n') if not x.startswith('#')]
-	temp_filename = os.path.join(os.path.dirname(filename), 'temp_'+os.path.basename(filename))
-	fh = open(temp_filename, 'w')
-	fh.write('\n'.join(filedata))
-	fh.close()
-	return temp_filename
-	
+	clin_attrs = get_file_header(clin_filename)
+	for sample_id,sample_data in clean_sample_rows(clin_filename, clin_attrs, report_fixes = False):
+		update_attribute_counts(clin_attrs, sample_data)
 
-def calculate_genomic_alterations(maf_filename):
+
+def get_maf_filename(clin_filename):
 	"""
+		Returns the MAF in the same directory as the clinical file, or None if there isn't one.
 	"""
-	temp_filename = write_temp_file(maf_filename)
-	print 'Writing temp MAF file to:', temp_filename
-	
-	maf_file = open(temp_filename, 'rU')
-	maf_reader = csv.DictReader(maf_file, dialect = 'excel-tab')
+	for filename in MAF_FILENAMES:
+		maf_filename = os.path.join(os.path.dirname(clin_filename), filename)
+		if os.path.exists(maf_filename):
+			return maf_filename
+	return None
+
 
+def calculate_genomic_alterations(maf_filename, column = 'Tumor_Sample_Barcode'):
+	"""
+		Counts the MAF records for each sample in a single pass.
+		Commented lines are skipped as they are read and each record is only
+		split as far as the sample id column.
+	"""
+	maf_file = curation_io.open_input_file(maf_filename)
+
+	column_index = None
 	genomic_alts_data = {}
-	for line in maf_reader:
-		sample_id = line['Tumor_Sample_Barcode'].strip()
+	for line in maf_file:
+		if line.startswith('#'):
+			continue
+		if column_index is None:
+			maf_header = map(str.strip, line.split('\t'))
+			if column not in maf_header:
+				print 'ERROR: Could not find', column, 'column in MAF:', maf_filename
+				sys.exit(2)
+			column_index = maf_header.index(column)
+			continue
+
+		line_data = line.split('\t', column_index + 1)
+		if len(line_data) <= column_index:
+			continue
+		sample_id = line_data[column_index].strip()
 		genomic_alts_data[sample_id] = genomic_alts_data.get(sample_id, 0) + 1
+	maf_file.close()
 
-	maf_file.close()	
-	os.remove(temp_filename)
-	print 'Removed temp MAF file.'	
 	return genomic_alts_data
 
 
-def normalize_attribute_data(ptype, norm_attr, sample_data):
+def normalize_attribute_data(ptype, norm_attr, orig_vals, value_tables):
 	"""
+		Returns the normalized value for the original values of a sample.
+		Each value table is a (original value -> normalized value, normalized values)
+		pair for the original attribute at the same position in orig_vals.
 	"""
-	norm_attr_data = CLINICAL_DATA_MAP[ptype].get(norm_attr)
-	orig_attrs = list(norm_attr_data.keys())
-
-	orig_vals = map(lambda x: sample_data.get(x, 'NA'), orig_attrs)
-	
 	if ptype == 'MERGE':
-		value = []
-		for val in orig_vals:
-			value.extend(val.split('/'))
-
-		if not value:
-			norm_val = 'NA'
-		else:
-			norm_val_list = []
-			for i,val in enumerate(value):
-				new_val = norm_attr_data[orig_attrs[i]].get(val, 'NA')
+		norm_val_list = []
+		for i,val in enumerate(orig_vals):
+			value_map = value_tables[i][0]
+			for v in val.split('/'):
+				new_val = value_map.get(v, 'NA')
 				if new_val == None:
 					continue
 				norm_val_list.extend(new_val.split('/'))
 
-			norm_val_list = list(set(norm_val_list))
-			if len(norm_val_list) > 0:
-				norm_val_list = [v for v in norm_val_list if v != 'None']
-				
-			if not norm_val_list:
-				norm_val = 'NA'
-			else:
-				norm_val = '/'.join(sorted(norm_val_list))
+		norm_val_list = [v for v in set(norm_val_list) if v != 'None']
+		if not norm_val_list:
+			norm_val = 'NA'
+		else:
+			norm_val = '/'.join(sorted(norm_val_list))
 
 	else:
 		if len(set(orig_vals)) > 1:
 			print 'ERROR: more than one original value retrieved from matched original attribute.'
 			print 'PTYPE:', ptype
 			print 'NORM_ATTRIBUTE:', norm_attr
-			print 'NORM_ATTRIBUTE_DATA:', norm_attr_data
-			print 'ORIGINAL_ATTRIBUTE(S):', orig_attrs
+			print 'NORM_ATTRIBUTE_DATA:', CLINICAL_DATA_MAP[ptype].get(norm_attr)
+			print 'ORIGINAL_ATTRIBUTE(S):', NORMALIZATION_PLAN[norm_attr][1]
 			print 'ORIGINAL_VALUE(S):', orig_vals
 			sys.exit(2)
 		else:
 			if orig_vals[0] == 'NA':
 				norm_val = orig_vals[0]
 			else:
-				try:
-					orig_attr_data = norm_attr_data.get(orig_attrs[0])
-					norm_val = orig_attr_data.get(orig_vals[0])
-					if norm_val == None:
-						if orig_vals[0] in orig_attr_data.values():
-							norm_val = orig_vals[0]
-					
-				except AttributeError:
-					print 'EXCEPTION: AttributeError'
-					print 'NORM_ATTR_DATA:', norm_attr_data
-					print 'ORIG_ATTRS:', orig_attrs
-					print 'ORIG_VALS:', orig_vals
-					print '\n\n'					
+				value_map,norm_vals = value_tables[0]
+				norm_val = value_map.get(orig_vals[0])
+				if norm_val == None and orig_vals[0] in norm_vals:
+					norm_val = orig_vals[0]
 	return norm_val
 
 
@@ -246,59 +359,365 @@ def get_processing_type(norm_attr):
 	return None
 
 
-def get_normalized_sample_data(sample_data, header):
+def compile_normalization_plan():
 	"""
+		Compiles CLINICAL_DATA_MAP into NORMALIZATION_PLAN so that the processing type,
+		original attributes and value tables of each normalized attribute are looked up once.
 	"""
-	for norm_attr in header:
-		if norm_attr in CLINICAL_DATA_MAP.get('KEEP_ALL'):
-			continue
-		elif norm_attr == 'GENOMIC_ALTERATIONS':
+	keep_all_attrs = CLINICAL_DATA_MAP.get('KEEP_ALL', [])
+	for norm_attr in NORMALIZED_ATTRIBUTE_LIST:
+		if norm_attr in keep_all_attrs:
+			NORMALIZATION_PLAN[norm_attr] = ('KEEP_ALL', [], None)
 			continue
 
 		ptype = get_processing_type(norm_attr)
 		if ptype in ['MERGE', 'DERIVE', 'FIX_ALL', 'FIX_VALUE', 'FIX_ATTRIBUTE']:
-			norm_val = normalize_attribute_data(ptype, norm_attr, sample_data)
-			sample_data[norm_attr] = norm_val
+			norm_attr_data = CLINICAL_DATA_MAP[ptype].get(norm_attr)
+			orig_attrs = list(norm_attr_data.keys())
+			value_tables = [(norm_attr_data[attr], set(norm_attr_data[attr].values())) for attr in orig_attrs]
+			NORMALIZATION_PLAN[norm_attr] = (ptype, orig_attrs, value_tables)
 		elif ptype == 'ADD_ALL':
-			norm_val = CLINICAL_DATA_MAP[ptype].get(norm_attr)
-			sample_data[norm_attr] = norm_val
+			NORMALIZATION_PLAN[norm_attr] = (ptype, [], CLINICAL_DATA_MAP[ptype].get(norm_attr))
+
+
+def get_row_plan(clin_attrs, header, map_clinical_data):
+	"""
+		Resolves the normalization plan against the clinical file columns.
+
+		Returns (steps, output indices, row width). Every attribute gets one slot in the
+		sample row - either its clinical file column or an extra slot appended after them -
+		and each step writes its normalized value into the slot of its normalized attribute,
+		reading the original values from the slots of its original attributes.
+	"""
+	attr_index = {}
+	for attr in clin_attrs + header:
+		if attr not in attr_index:
+			attr_index[attr] = len(attr_index)
+
+	def get_slot(attr):
+		if attr not in attr_index:
+			attr_index[attr] = len(attr_index)
+		return attr_index[attr]
+
+	steps = []
+	if 'GENOMIC_ALTERATIONS' in header:
+		steps.append(('ADD_GENOMIC_ALTERATIONS', 'GENOMIC_ALTERATIONS', get_slot('GENOMIC_ALTERATIONS'), None, None))
+
+	if map_clinical_data:
+		for norm_attr in header:
+			if norm_attr == 'GENOMIC_ALTERATIONS':
+				continue
+
+			ptype,orig_attrs,value_tables = NORMALIZATION_PLAN.get(norm_attr, (None, [], None))
+			if ptype == 'KEEP_ALL':
+				continue
+			elif ptype in ['MERGE', 'DERIVE', 'FIX_ALL', 'FIX_VALUE', 'FIX_ATTRIBUTE', 'ADD_ALL']:
+				steps.append((ptype, norm_attr, get_slot(norm_attr), map(get_slot, orig_attrs), value_tables))
+			else:
+				print 'ERROR: Attribute in header has not been normalized.'
+				print norm_attr
+				sys.exit(2)
+
+	output_indices = map(get_slot, header)
+	return steps, output_indices, len(attr_index)
+
+
+def get_normalized_sample_data(sample_data, row_plan, genomic_alterations = None):
+	"""
+		Runs the row plan over the sample data and returns the processed values in header order.
+	"""
+	steps,output_indices,row_width = row_plan
+	row = sample_data + ['NA'] * (row_width - len(sample_data))
+	for ptype,norm_attr,dest,src_indices,value_tables in steps:
+		if ptype == 'ADD_GENOMIC_ALTERATIONS':
+			row[dest] = genomic_alterations
+		elif ptype == 'ADD_ALL':
+			row[dest] = value_tables
 		else:
-			print 'ERROR: Attribute in header has not been normalized.'
-			print norm_attr
-			sys.exit(2)
+			# clinical values have low cardinality so most rows are served from the cache
+			orig_vals = tuple([row[i] for i in src_indices])
+			key = (ptype, norm_attr, orig_vals)
+			try:
+				row[dest] = NORMALIZATION_CACHE[key]
+				NORMALIZATION_CACHE_STATS['hits'] += 1
+			except KeyError:
+				NORMALIZATION_CACHE_STATS['misses'] += 1
+				norm_val = normalize_attribute_data(ptype, norm_attr, list(orig_vals), value_tables)
+				if len(NORMALIZATION_CACHE) < NORMALIZATION_CACHE_SIZE:
+					NORMALIZATION_CACHE[key] = norm_val
+				row[dest] = norm_val
+	return [row[i] for i in output_indices]
 
-	processed_sample_data = map(lambda x: sample_data.get(x, 'NA'), header)
-	return processed_sample_data
+
+def get_processed_line(sample_data, row_plan, genomic_alterations, previous_line):
+	"""
+		Returns the processed line for the sample, reusing the line from the previous run if there is one.
+	"""
+	if previous_line != None:
+		return previous_line
+	return '\t'.join(get_normalized_sample_data(sample_data, row_plan, genomic_alterations))
 
 
-def cleanup_clinical_data(clin_filename, output_directory, map_clinical_data, calc_genomic_alterations):
+def get_row_hash(sample_data):
 	"""
+		Returns the fingerprint of the cleaned sample data.
 	"""
-	basic_sample_data = basic_clinical_cleanup(clin_filename)
-	header = get_header(clin_filename, map_clinical_data, calc_genomic_alterations)
-	# if 'ONCOTREE_CODE' not in header:
-	# 	header.append('ONCOTREE_CODE')
+	return hashlib.sha1('\t'.join(sample_data)).hexdigest()
 
-	if calc_genomic_alterations:
-		maf_filename = os.path.join(os.path.dirname(clin_filename), 'data_mutations_extended.txt')
-		genomic_alts_data = calculate_genomic_alterations(maf_filename)
 
-	output = ['\t'.join(header)]
-	for sample_id,sample_data in basic_sample_data.items():
-		if calc_genomic_alterations:
-			sample_data['GENOMIC_ALTERATIONS'] = str(genomic_alts_data.get(sample_id, 0))
+def get_run_fingerprint(clin_attrs, header, map_filename, maf_filename):
+	"""
+		Returns everything besides the sample rows that the processed clinical file depends on.
+	"""
+	return {
+		'version':MANIFEST_VERSION,
+		'clinical_attributes':clin_attrs,
+		'header':header,
+		'map_hash':map_filename and curation_io.get_file_hash(map_filename),
+		'maf_hash':maf_filename and curation_io.get_file_hash(maf_filename)
+	}
+
+
+def open_previous_output(output_filename):
+	""" Opens the processed file from the previous run for reading its lines by byte offset. """
+	if curation_io.is_compressed(output_filename):
+		return gzip.open(output_filename, 'rb')
+	return open(output_filename, 'rb')
+
+
+def read_previous_line(previous_file, offset):
+	""" Returns the processed line at the byte offset of the processed file from the previous run. """
+	previous_file.seek(offset)
+	return previous_file.readline().rstrip('\n')
+
+
+def load_previous_run(output_filename, run_fingerprint):
+	"""
+		Returns the row hashes and the byte offsets of the processed lines by sample id from the previous run.
+		Only the offsets are kept, so that the previous processed lines are not all held in memory
+		and are read back one at a time as unchanged samples are written.
+		Both are empty if there is no previous run or if the map, MAF or header have
+		changed since then, in which case every row is reprocessed.
+	"""
+	manifest_filename = output_filename + MANIFEST_EXTENSION
+	if not os.path.exists(manifest_filename) or not os.path.exists(output_filename):
+		print 'No manifest from a previous run found - processing all samples.'
+		return {},{}
+
+	manifest_file = open(manifest_filename, 'rU')
+	manifest = json.load(manifest_file)
+	manifest_file.close()
+	for key,value in run_fingerprint.items():
+		if manifest.get(key) != value:
+			print 'Clinical data map, MAF or header changed since previous run - processing all samples.'
+			return {},{}
+
+	line_offsets = {}
+	output_file = open_previous_output(output_filename)
+	line = output_file.readline()
+	offset = len(line)
+	previous_header = map(str.strip, line.split('\t'))
+	if 'SAMPLE_ID' not in previous_header:
+		# processed lines can only be matched to their samples by the SAMPLE_ID column
+		output_file.close()
+		print 'No SAMPLE_ID column in processed file from previous run - processing all samples.'
+		return {},{}
+	sample_id_index = previous_header.index('SAMPLE_ID')
+	for line in output_file:
+		line_offsets[line.split('\t', sample_id_index + 1)[sample_id_index].rstrip('\n')] = offset
+		offset += len(line)
+	output_file.close()
+	return manifest['rows'],line_offsets
+
+
+def write_manifest(output_filename, run_fingerprint, row_hashes):
+	"""
+		Writes the manifest of row fingerprints for the processed clinical file.
+	"""
+	manifest = dict(run_fingerprint)
+	manifest['rows'] = row_hashes
 
-		if map_clinical_data:
-			processed_sample_data = get_normalized_sample_data(sample_data, header)
+	manifest_filename = output_filename + MANIFEST_EXTENSION
+	temp_manifest_filename = manifest_filename + '.' + str(os.getpid())
+	manifest_file = open(temp_manifest_filename, 'w')
+	json.dump(manifest, manifest_file)
+	manifest_file.close()
+	os.rename(temp_manifest_filename, manifest_filename)
+	print 'Manifest written to:', os.path.abspath(manifest_filename)
+
+
+def init_normalization_worker(row_plan):
+	"""
+		Sets the row plan for a normalization worker process.
+	"""
+	global WORKER_ROW_PLAN
+	WORKER_ROW_PLAN = row_plan
+
+
+def normalize_sample_chunk(chunk):
+	"""
+		Normalizes a chunk of (sample data, genomic alterations, previous line) tuples in a worker process.
+		Returns the processed sample lines and the normalization cache stats for the chunk.
+	"""
+	hits = NORMALIZATION_CACHE_STATS['hits']
+	misses = NORMALIZATION_CACHE_STATS['misses']
+	try:
+		lines = [get_processed_line(sample_data, WORKER_ROW_PLAN, genomic_alterations, previous_line) for sample_data,genomic_alterations,previous_line in chunk]
+		return lines, NORMALIZATION_CACHE_STATS['hits'] - hits, NORMALIZATION_CACHE_STATS['misses'] - misses
+	except SystemExit:
+		# sys.exit() would take down the worker and leave the pool waiting on it
+		raise RuntimeError('Normalization failed in worker process - see errors above.')
+
+
+def normalize_samples_in_pool(normalize_inputs, row_plan, workers):
+	"""
+		Yields processed sample lines, normalizing chunks of samples across a pool of worker processes.
+		Chunks are submitted a few at a time and results are yielded in input order.
+	"""
+	def get_chunk_lines(chunks):
+		for lines,hits,misses in pool.map(normalize_sample_chunk, chunks):
+			NORMALIZATION_CACHE_STATS['hits'] += hits
+			NORMALIZATION_CACHE_STATS['misses'] += misses
+			for line in lines:
+				yield line
+
+	pool = multiprocessing.Pool(workers, init_normalization_worker, (row_plan,))
+	try:
+		chunks = []
+		chunk = []
+		for sample in normalize_inputs:
+			chunk.append(sample)
+			if len(chunk) == WORKER_CHUNK_SIZE:
+				chunks.append(chunk)
+				chunk = []
+			if len(chunks) == workers * 2:
+				for line in get_chunk_lines(chunks):
+					yield line
+				chunks = []
+		if chunk:
+			chunks.append(chunk)
+		for line in get_chunk_lines(chunks):
+			yield line
+		pool.close()
+	except RuntimeError as e:
+		print 'ERROR:', e
+		sys.exit(2)
+	finally:
+		pool.terminate()
+		pool.join()
+
+
+def cleanup_clinical_data(clin_filename, output_directory, map_clinical_data, calc_genomic_alterations, streaming = False, workers = 1, incremental = False, map_filename = None, compress = False):
+	"""
+		Cleans up and normalizes the clinical data and writes it to the output directory.
+
+		In streaming mode the clinical file is read twice: the first pass only gathers
+		the clinical attribute counts and the second pass cleans, normalizes and writes
+		each sample as it is read, so sample data is never held in memory all at once.
+		Samples are written in file order and duplicate sample ids are not merged.
+
+		With more than one worker, samples are normalized in chunks across a process pool
+		and written in the same order as they would be with a single worker.
+
+		In incremental mode a manifest with a fingerprint of each sample row is kept next
+		to the processed file, and only samples whose rows changed since the previous run
+		are normalized again. All samples are processed if the map, MAF or header changed.
+		The processed lines of unchanged samples are read back from the previous processed file
+		by byte offset, so only the row fingerprints and offsets are held in memory.
+
+		The processed file is gzipped if compress is set.
+	"""
+	with curation_metrics.stage('header_read'):
+		clin_attrs = get_file_header(clin_filename)
+	with curation_metrics.stage('cleanup_pass'):
+		if streaming:
+			count_clinical_attributes(clin_filename)
+			sample_rows = clean_sample_rows(clin_filename, clin_attrs)
 		else:
-			processed_sample_data = map(lambda x: sample_data.get(x, 'NA'), header)
+			sample_rows = basic_clinical_cleanup(clin_filename).iteritems()
+	curation_metrics.add_file_size('input_bytes', clin_filename)
 
-		output.append('\t'.join(processed_sample_data))
+	with curation_metrics.stage('header_build'):
+		header = get_header(clin_filename, map_clinical_data, calc_genomic_alterations)
+		row_plan = get_row_plan(clin_attrs, header, map_clinical_data)
+	# if 'ONCOTREE_CODE' not in header:
+	# 	header.append('ONCOTREE_CODE')
 
-	output_filename = os.path.join(output_directory, 'processed-'+os.path.basename(clin_filename))
-	fh = open(output_filename, 'w')
-	fh.write('\n'.join(output))
-	fh.close()
+	maf_filename = None
+	if calc_genomic_alterations:
+		with curation_metrics.stage('maf_count'):
+			maf_filename = get_maf_filename(clin_filename)
+			genomic_alts_data = calculate_genomic_alterations(maf_filename)
+		curation_metrics.add_file_size('maf_bytes', maf_filename)
+
+	output_filename = curation_io.get_output_filename(os.path.join(output_directory, 'processed-'+os.path.basename(curation_io.get_uncompressed_filename(clin_filename))), compress, clin_filename)
+
+	previous_row_hashes = {}
+	previous_line_offsets = {}
+	previous_file = None
+	row_hashes = {}
+	reused_counts = {'reused':0, 'processed':0}
+	if incremental:
+		with curation_metrics.stage('load_previous_run'):
+			run_fingerprint = get_run_fingerprint(clin_attrs, header, map_clinical_data and map_filename, maf_filename)
+			previous_row_hashes,previous_line_offsets = load_previous_run(output_filename, run_fingerprint)
+		if previous_line_offsets:
+			# unchanged samples are read back from the previous output, which stays readable after it is replaced
+			previous_file = open_previous_output(output_filename)
+
+	def get_normalize_inputs():
+		for sample_id,sample_data in sample_rows:
+			genomic_alterations = None
+			if calc_genomic_alterations:
+				genomic_alterations = str(genomic_alts_data.get(sample_id, 0))
+
+			previous_line = None
+			if incremental:
+				row_hash = get_row_hash(sample_data)
+				row_hashes[sample_id] = row_hash
+				if previous_row_hashes.get(sample_id) == row_hash and sample_id in previous_line_offsets:
+					previous_line = read_previous_line(previous_file, previous_line_offsets[sample_id])
+				if previous_line == None:
+					reused_counts['processed'] += 1
+				else:
+					reused_counts['reused'] += 1
+			yield sample_data, genomic_alterations, previous_line
+	normalize_inputs = get_normalize_inputs()
+
+	with curation_metrics.stage('normalize_and_write'):
+		temp_output_filename = output_filename + '.tmp'
+		fh = curation_io.open_output_file(temp_output_filename, output_filename = output_filename)
+		try:
+			fh.write('\t'.join(header))
+
+			if workers > 1:
+				processed_lines = normalize_samples_in_pool(normalize_inputs, row_plan, workers)
+			else:
+				processed_lines = (get_processed_line(sample_data, row_plan, genomic_alterations, previous_line) for sample_data,genomic_alterations,previous_line in normalize_inputs)
+
+			num_rows = 0
+			for line in processed_lines:
+				fh.write('\n' + line)
+				num_rows += 1
+			fh.close()
+			os.rename(temp_output_filename, output_filename)
+		finally:
+			# don't leave a partial processed file behind if normalization fails or exits
+			if os.path.exists(temp_output_filename):
+				fh.close()
+				os.remove(temp_output_filename)
+	if previous_file != None:
+		previous_file.close()
+	curation_metrics.add_count('rows', num_rows)
+	curation_metrics.add_file_size('output_bytes', output_filename)
+
+	if incremental:
+		print 'Reused', reused_counts['reused'], 'unchanged samples and processed', reused_counts['processed'], 'new or changed samples.'
+		write_manifest(output_filename, run_fingerprint, row_hashes)
+
+	close_audit_log()
+	if map_clinical_data:
+		print 'Normalization cache:', NORMALIZATION_CACHE_STATS['hits'], 'hits,', NORMALIZATION_CACHE_STATS['misses'], 'misses.'
 
 	print 'Filtered clinical data written to:', os.path.abspath(output_filename)
 
@@ -353,6 +772,59 @@ def generate_clinical_data_map(filename):
 		elif ptype == 'IGNORE' and orig_attr not in POST_PROCESS_ATTRIBUTE_FILTER:
 			POST_PROCESS_ATTRIBUTE_FILTER.append(orig_attr)
 	print CLINICAL_DATA_MAP['MERGE']
+	compile_normalization_plan()
+
+
+def load_clinical_data_map(map_filename, use_cache = True):
+	"""
+		Loads the compiled clinical data map from the cache next to the map file.
+		The cache is keyed by the content hash of the map file, and is rebuilt
+		with generate_clinical_data_map whenever it is missing or out of date.
+	"""
+	if not use_cache:
+		generate_clinical_data_map(map_filename)
+		return
+
+	cache_filename = map_filename + MAP_CACHE_EXTENSION
+	map_hash = curation_io.get_file_hash(map_filename)
+	if os.path.exists(cache_filename):
+		try:
+			cache_file = open(cache_filename, 'rb')
+			cache = cPickle.load(cache_file)
+			cache_file.close()
+		except Exception as e:
+			print 'WARNING: Could not read compiled clinical data map cache:', cache_filename, '-', e
+			cache = {}
+
+		if cache.get('version') == MAP_CACHE_VERSION and cache.get('map_hash') == map_hash:
+			CLINICAL_DATA_MAP.update(cache['CLINICAL_DATA_MAP'])
+			NORMALIZED_ATTRIBUTE_LIST.extend(cache['NORMALIZED_ATTRIBUTE_LIST'])
+			POST_PROCESS_ATTRIBUTE_FILTER.extend(cache['POST_PROCESS_ATTRIBUTE_FILTER'])
+			NORMALIZATION_PLAN.update(cache['NORMALIZATION_PLAN'])
+			print 'Loaded compiled clinical data map from:', os.path.abspath(cache_filename)
+			return
+		print 'Compiled clinical data map cache is out of date - rebuilding.'
+
+	generate_clinical_data_map(map_filename)
+
+	cache = {
+		'version':MAP_CACHE_VERSION,
+		'map_hash':map_hash,
+		'CLINICAL_DATA_MAP':CLINICAL_DATA_MAP,
+		'NORMALIZED_ATTRIBUTE_LIST':NORMALIZED_ATTRIBUTE_LIST,
+		'POST_PROCESS_ATTRIBUTE_FILTER':POST_PROCESS_ATTRIBUTE_FILTER,
+		'NORMALIZATION_PLAN':NORMALIZATION_PLAN
+	}
+	# write to a temp file first so that concurrent runs never read a partial cache
+	temp_cache_filename = cache_filename + '.' + str(os.getpid())
+	try:
+		cache_file = open(temp_cache_filename, 'wb')
+		cPickle.dump(cache, cache_file, cPickle.HIGHEST_PROTOCOL)
+		cache_file.close()
+		os.rename(temp_cache_filename, cache_filename)
+		print 'Compiled clinical data map cache written to:', os.path.abspath(cache_filename)
+	except (IOError, OSError) as e:
+		print 'WARNING: Could not write compiled clinical data map cache:', cache_filename, '-', e
 
 
 def processing_type_rules():
@@ -364,7 +836,7 @@ def processing_type_rules():
 
 
 def usage():
-	print >> OUTPUT_FILE, 'clinical_cleanup.py --clinical-file [path/to/clinical/file] --output-directory [path/to/output/directory] --map-file [path/to/map/file] --genomic-alterations [True/False]'
+	print >> OUTPUT_FILE, 'clinical_cleanup.py --clinical-file [path/to/clinical/file] --output-directory [path/to/output/directory] --map-file [path/to/map/file] --genomic-alterations [True/False] [--streaming] [--workers N] [--no-map-cache] [--audit-file path/to/audit/file.(tsv|jsonl)] [--incremental] [--compress-output] [--metrics-json path/to/metrics.json]'
 
 
 def main():
@@ -374,13 +846,27 @@ def main():
 	parser.add_option('-d', '--output-directory', action = 'store', dest = 'outputdir')
 	parser.add_option('-m', '--map-file', action = 'store', dest = 'mapfile')
 	parser.add_option('-g', '--genomic-alterations', action = 'store', dest = 'genalts')
+	parser.add_option('-s', '--streaming', action = 'store_true', dest = 'streaming', default = False)
+	parser.add_option('-w', '--workers', action = 'store', dest = 'workers', type = 'int', default = 1)
+	parser.add_option('-n', '--no-map-cache', action = 'store_false', dest = 'usemapcache', default = True)
+	parser.add_option('-a', '--audit-file', action = 'store', dest = 'auditfile')
+	parser.add_option('-i', '--incremental', action = 'store_true', dest = 'incremental', default = False)
+	parser.add_option('-z', '--compress-output', action = 'store_true', dest = 'compressoutput', default = False)
+	parser.add_option('--metrics-json', action = 'store', dest = 'metricsjson')
 
 	(options, args) = parser.parse_args()
+	curation_metrics.enable_metrics('clinical_cleanup', options.metricsjson)
 
 	clin_filename = options.clinfile
 	output_directory = options.outputdir
 	map_filename = options.mapfile
 	genomic_alterations = options.genalts
+	streaming = options.streaming
+	workers = options.workers
+	use_map_cache = options.usemapcache
+	audit_filename = options.auditfile
+	incremental = options.incremental
+	compress_output = options.compressoutput
 
 
 	map_clinical_data = False
@@ -404,7 +890,8 @@ def main():
 	else: 
 		if os.path.exists(map_filename):			
 			print 'Mapping clinical attributes and data using:', os.path.abspath(map_filename)
-			generate_clinical_data_map(map_filename)
+			with curation_metrics.stage('map_compile'):
+				load_clinical_data_map(map_filename, use_map_cache)
 			map_clinical_data = True
 		else:
 			print 'ERROR: No such file:', map_filename
@@ -422,8 +909,8 @@ def main():
 		elif genomic_alterations == 'false':
 			print 'Genomic alterations will not be calculated for clinical file.'
 		elif genomic_alterations == 'true':
-			maf_filename = os.path.join(os.path.dirname(clin_filename), 'data_mutations_extended.txt')
-			if not os.path.exists(maf_filename):
+			maf_filename = get_maf_filename(clin_filename)
+			if maf_filename == None:
 				print 'ERROR: MAF file could not be found in directory:', os.path.dirname(clin_filename)
 				print 'ERROR: Please make sure that MAF file exists in same directory as clinical file.'
 				sys.exit(2)
@@ -431,7 +918,24 @@ def main():
 				print 'Genomic alterations will be calculated from:', os.path.abspath(maf_filename)
 				calc_genomic_alterations = True
 
-	cleanup_clinical_data(clin_filename, output_directory, map_clinical_data, calc_genomic_alterations)
+	if workers < 1:
+		print 'ERROR: Invalid number of workers:', workers
+		sys.exit(2)
+	elif workers > 1:
+		print 'Normalizing clinical data using', workers, 'worker processes.'
+
+	if streaming:
+		print 'Streaming clinical data - samples will be cleaned and written one at a time.'
+
+	if audit_filename == None:
+		print 'No audit file provided - only value fix counts per column will be reported.'
+	else:
+		open_audit_log(audit_filename)
+
+	if incremental:
+		print 'Incremental mode - only new or changed samples will be processed.'
+
+	cleanup_clinical_data(clin_filename, output_directory, map_clinical_data, calc_genomic_alterations, streaming, workers, incremental, map_filename, compress_output)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,274 @@
+import io
+import os
+import sys
+import gzip
+import hashlib
+import zlib
+import struct
+import traceback
+import multiprocessing
+
+import curation_metrics
+
+# compressed file extensions - .bgz files are block gzipped (BGZF), which any gzip reader can stream
+GZIP_EXTENSION = '.gz'
+BGZIP_EXTENSION = '.bgz'
+COMPRESSED_EXTENSIONS = [GZIP_EXTENSION, BGZIP_EXTENSION]
+
+READ_BUFFER_SIZE = 1024 * 1024
+COMPRESSION_LEVEL = 6
+
+# largest amount of data compressed into one BGZF block, and the empty block that marks the end of a BGZF file
+BGZF_BLOCK_SIZE = 0xff00
+BGZF_EOF = '\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00'
+
+
+class BgzfWriter(object):
+	"""
+		Writes a block gzipped (BGZF) file, i.e. for tabix or samtools.
+		Data is compressed into independent gzip blocks of at most BGZF_BLOCK_SIZE bytes.
+	"""
+	def __init__(self, filename, mode = 'wb'):
+		self.output_file = open(filename, mode)
+		self.buffer = []
+		self.buffer_size = 0
+
+	@property
+	def closed(self):
+		return self.output_file.closed
+
+	def write(self, data):
+		self.buffer.append(data)
+		self.buffer_size += len(data)
+		if self.buffer_size >= BGZF_BLOCK_SIZE:
+			data = ''.join(self.buffer)
+			while len(data) >= BGZF_BLOCK_SIZE:
+				self.write_block(data[:BGZF_BLOCK_SIZE])
+				data = data[BGZF_BLOCK_SIZE:]
+			self.buffer = [data]
+			self.buffer_size = len(data)
+
+	def write_block(self, data):
+		compressor = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS)
+		compressed_data = compressor.compress(data) + compressor.flush()
+		# gzip header with the BC extra field holding the total block size minus one
+		self.output_file.write('\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00')
+		self.output_file.write(struct.pack('<H', len(compressed_data) + 25))
+		self.output_file.write(compressed_data)
+		self.output_file.write(struct.pack('<II', zlib.crc32(data) & 0xffffffff, len(data)))
+
+	def close(self):
+		if self.output_file.closed:
+			return
+		data = ''.join(self.buffer)
+		if data:
+			self.write_block(data)
+		self.buffer = []
+		self.buffer_size = 0
+		self.output_file.write(BGZF_EOF)
+		self.output_file.close()
+
+
+class UniversalNewlineReader(object):
+	"""
+		Reads a binary stream with universal newlines, like files opened with 'rU':
+		\r\n and \r line endings are read as \n.
+	"""
+	def __init__(self, input_file):
+		self.input_file = input_file
+		self.pending = ''
+		self.after_cr = False
+
+	@property
+	def closed(self):
+		return self.input_file.closed
+
+	def translate(self, data):
+		# a \r\n split across reads is a single line ending
+		if self.after_cr and data.startswith('\n'):
+			data = data[1:]
+		self.after_cr = data.endswith('\r')
+		return data.replace('\r\n', '\n').replace('\r', '\n')
+
+	def read(self, size = -1):
+		if size < 0:
+			data = self.pending + self.translate(self.input_file.read())
+			self.pending = ''
+			return data
+		while not self.pending:
+			data = self.input_file.read(size)
+			if not data:
+				break
+			self.pending = self.translate(data)
+		data = self.pending[:size]
+		self.pending = self.pending[size:]
+		return data
+
+	def readline(self):
+		if not self.pending:
+			line = self.input_file.readline()
+			if '\r' not in line and not self.after_cr:
+				return line
+			self.pending = self.translate(line)
+		while '\n' not in self.pending:
+			data = self.input_file.readline()
+			if not data:
+				break
+			self.pending += self.translate(data)
+		end = self.pending.find('\n') + 1 or len(self.pending)
+		line = self.pending[:end]
+		self.pending = self.pending[end:]
+		return line
+
+	def __iter__(self):
+		return self
+
+	def next(self):
+		line = self.readline()
+		if not line:
+			raise StopIteration
+		return line
+
+	def close(self):
+		self.input_file.close()
+
+
+def is_compressed(filename):
+	""" Returns whether the file is gzip or bgzip compressed, going by its extension. """
+	return os.path.splitext(filename)[1] in COMPRESSED_EXTENSIONS
+
+
+def get_uncompressed_filename(filename):
+	""" Returns the filename without its .gz or .bgz extension, i.e. for matching study file names. """
+	if is_compressed(filename):
+		return os.path.splitext(filename)[0]
+	return filename
+
+
+def get_output_filename(filename, compress = False, input_filename = None):
+	"""
+		Returns the output filename, with a .gz extension if the output is compressed,
+		or a .bgz extension if the input file it is written from is block gzipped.
+	"""
+	filename = get_uncompressed_filename(filename)
+	if compress:
+		if input_filename != None and input_filename.endswith(BGZIP_EXTENSION):
+			return filename + BGZIP_EXTENSION
+		return filename + GZIP_EXTENSION
+	return filename
+
+
+def get_file_signature(filename):
+	"""
+		Returns the size and modification time used to tell whether an index or cache built from the file is out of date.
+		The modification time keeps its sub-second part, so a file rewritten within the same second is still noticed.
+	"""
+	stat = os.stat(filename)
+	return str(stat.st_size), repr(stat.st_mtime)
+
+
+def get_file_hash(filename):
+	""" Returns the SHA-1 hex digest of the file contents, i.e. to tell whether a file changed since a previous run. """
+	file_hash = hashlib.sha1()
+	fh = open(filename, 'rb')
+	for chunk in iter(lambda: fh.read(1 << 20), ''):
+		file_hash.update(chunk)
+	fh.close()
+	return file_hash.hexdigest()
+
+
+def open_input_file(filename):
+	"""
+		Opens the file for reading with universal newlines.
+		Compressed files are decompressed as they are read, so they never have to be unpacked to disk.
+	"""
+	if is_compressed(filename):
+		return UniversalNewlineReader(io.BufferedReader(gzip.open(filename, 'rb'), READ_BUFFER_SIZE))
+	return open(filename, 'rU')
+
+
+def open_output_file(filename, buffer_size = -1, output_filename = None, append = False):
+	"""
+		Opens the file for writing, or for appending if append is set.
+		Files ending in .gz are gzip compressed and files ending in .bgz are block gzip compressed.
+		When writing to a temp file, the compression goes by the output filename it will be renamed to.
+		Appending to a compressed file adds a new gzip member, which readers decompress as one stream.
+	"""
+	if output_filename == None:
+		output_filename = filename
+	mode = 'a' if append else 'w'
+	if output_filename.endswith(BGZIP_EXTENSION):
+		return BgzfWriter(filename, mode + 'b')
+	elif output_filename.endswith(GZIP_EXTENSION):
+		return gzip.open(filename, mode + 'b', COMPRESSION_LEVEL)
+	return open(filename, mode, buffer_size)
+
+
+def run_file_task(task):
+	"""
+		Runs a task on a file and returns (filename, status, message).
+		The task is (function, filename, args...) and the function is called with the filename and args.
+		It returns the (status, message) of the file, and the status is 'failed' with the error as message if it raises or exits.
+	"""
+	function,filename = task[:2]
+	try:
+		status,message = function(filename, *task[2:])
+	except Exception:
+		message = traceback.format_exc()
+		print 'ERROR: Processing failed for file:', filename
+		print message
+		return filename, 'failed', message.strip().split('\n')[-1]
+	except SystemExit as e:
+		# sys.exit() would take down a pool worker and leave the pool waiting on it
+		return filename, 'failed', 'exited with code ' + str(e.code)
+	finally:
+		sys.stdout.flush()
+	return filename, status, message
+
+
+def run_file_task_in_worker(task):
+	""" Runs a task on a file in a pool worker and returns its result along with the metrics recorded while running it. """
+	snapshot = curation_metrics.get_metrics_snapshot()
+	result = run_file_task(task)
+	return result, curation_metrics.get_metrics_delta(snapshot)
+
+
+def run_file_tasks(function, tasks, jobs = 1, initializer = None, initargs = ()):
+	"""
+		Runs the function on each (filename, args...) task and returns the (filename, status, message) result of each file, sorted by filename.
+		With more than one job, files are processed in parallel across a process pool set up by the initializer,
+		and the metrics recorded in the workers are merged into this process.
+	"""
+	tasks = [(function,) + tuple(task) for task in tasks]
+	if jobs > 1 and len(tasks) > 1:
+		# hand the largest files out first so that they don't end up running last
+		tasks.sort(key = lambda task: -os.path.getsize(task[1]) if os.path.exists(task[1]) else 0)
+		pool = multiprocessing.Pool(min(jobs, len(tasks)), initializer, initargs)
+		try:
+			results = []
+			for result,metrics in pool.map(run_file_task_in_worker, tasks, chunksize = 1):
+				curation_metrics.merge_metrics(metrics)
+				results.append(result)
+			pool.close()
+		finally:
+			pool.terminate()
+			pool.join()
+	else:
+		results = map(run_file_task, tasks)
+	results.sort()
+	return results
+
+
+def print_file_results(results, action, file_type):
+	"""
+		Prints the result of each file, i.e. print_file_results(results, 'Filtering', 'data files'),
+		and returns the files that failed.
+	"""
+	print action, 'results:'
+	for filename,status,message in results:
+		print '\t' + status.upper() + '\t' + os.path.basename(filename) + ('\t' + message if message else '')
+
+	failed = [filename for filename,status,message in results if status == 'failed']
+	if failed:
+		print 'ERROR:', action, 'failed for', len(failed), 'of', len(results), file_type + '.'
+	return failed
@@ -0,0 +1,129 @@
+import os
+import sys
+import json
+import time
+import atexit
+import resource
+from contextlib import contextmanager
+
+# stage name -> {'wall_time', 'cpu_time', 'calls'} in the order the stages first ran
+STAGE_METRICS = {}
+STAGE_ORDER = []
+COUNTERS = {}
+RUN_METRICS = {'script':None, 'start_time':time.time(), 'start_times':os.times()}
+
+
+def get_cpu_time(times = None):
+	""" Returns the user + system CPU time of this process. """
+	if times == None:
+		times = os.times()
+	return times[0] + times[1]
+
+
+@contextmanager
+def stage(name):
+	"""
+		Times the wrapped block as the named stage.
+		Stages that run more than once (i.e., once per file) are added up.
+	"""
+	start_wall = time.time()
+	start_cpu = get_cpu_time()
+	try:
+		yield
+	finally:
+		stage_metrics = STAGE_METRICS.get(name)
+		if stage_metrics == None:
+			stage_metrics = {'wall_time':0.0, 'cpu_time':0.0, 'calls':0}
+			STAGE_METRICS[name] = stage_metrics
+			STAGE_ORDER.append(name)
+		stage_metrics['wall_time'] += time.time() - start_wall
+		stage_metrics['cpu_time'] += get_cpu_time() - start_cpu
+		stage_metrics['calls'] += 1
+
+
+def add_count(name, value = 1):
+	""" Adds to the named counter, i.e. rows or bytes processed. """
+	COUNTERS[name] = COUNTERS.get(name, 0) + value
+
+
+def add_file_size(name, filename):
+	""" Adds the size of the file to the named byte counter, if the file exists. """
+	if os.path.exists(filename):
+		add_count(name, os.path.getsize(filename))
+
+
+def get_metrics_snapshot():
+	""" Returns a copy of the stage metrics and counters so far, i.e. to take the metrics of a pool worker task. """
+	return dict([(name, dict(STAGE_METRICS[name])) for name in STAGE_ORDER]), dict(COUNTERS)
+
+
+def get_metrics_delta(snapshot):
+	"""
+		Returns the stage metrics and counters added since the snapshot as (stages, counters),
+		where stages is the list of (name, stage metrics) in the order the stages first ran.
+	"""
+	snapshot_stages,snapshot_counters = snapshot
+	stages = []
+	for name in STAGE_ORDER:
+		stage_metrics = dict(STAGE_METRICS[name])
+		for key,value in snapshot_stages.get(name, {}).items():
+			stage_metrics[key] -= value
+		if stage_metrics['calls'] > 0:
+			stages.append((name, stage_metrics))
+	counters = dict([(name, value - snapshot_counters.get(name, 0)) for name,value in COUNTERS.items() if value != snapshot_counters.get(name, 0)])
+	return stages, counters
+
+
+def merge_metrics(delta):
+	"""
+		Adds the stage metrics and counters from get_metrics_delta() to this process,
+		i.e. the metrics of a task that ran in a pool worker, which would otherwise be lost with the worker.
+	"""
+	stages,counters = delta
+	for name,delta_metrics in stages:
+		stage_metrics = STAGE_METRICS.get(name)
+		if stage_metrics == None:
+			stage_metrics = {'wall_time':0.0, 'cpu_time':0.0, 'calls':0}
+			STAGE_METRICS[name] = stage_metrics
+			STAGE_ORDER.append(name)
+		for key,value in delta_metrics.items():
+			stage_metrics[key] += value
+	for name,value in counters.items():
+		add_count(name, value)
+
+
+def get_metrics():
+	""" Returns the run metrics collected so far. """
+	end_times = os.times()
+	self_usage = resource.getrusage(resource.RUSAGE_SELF)
+	children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+	start_times = RUN_METRICS['start_times']
+	return {
+		'script':RUN_METRICS['script'],
+		'argv':sys.argv[1:],
+		'wall_time':time.time() - RUN_METRICS['start_time'],
+		'cpu_time':get_cpu_time(end_times) - get_cpu_time(start_times),
+		'children_cpu_time':(end_times[2] + end_times[3]) - (start_times[2] + start_times[3]),
+		'peak_rss_kb':self_usage.ru_maxrss,
+		'children_peak_rss_kb':children_usage.ru_maxrss,
+		'stages':[dict(STAGE_METRICS[name], name = name) for name in STAGE_ORDER],
+		'counters':COUNTERS
+	}
+
+
+def write_metrics(metrics_filename):
+	""" Writes the run metrics to the file as JSON. """
+	metrics_file = open(metrics_filename, 'w')
+	json.dump(get_metrics(), metrics_file, indent = 2, sort_keys = True)
+	metrics_file.close()
+	print 'Metrics written to:', os.path.abspath(metrics_filename)
+
+
+def enable_metrics(script_name, metrics_filename):
+	"""
+		Sets the script name for the run metrics and writes them to the file when the script exits,
+		including when it exits early with an error.
+	"""
+	RUN_METRICS['script'] = script_name
+	if metrics_filename != None:
+		atexit.register(write_metrics, metrics_filename)
@@ -2,13 +2,134 @@ import os
 import sys
 import optparse
 import csv
+import itertools
+
+import curation_metrics
+import curation_io
+import case_id_index
+import segment_interval_index
+import profile_matrix
+import subset_predicate
 
 # some file descriptors
 ERROR_FILE = sys.stderr
 OUTPUT_FILE = sys.stdout
 
-PATIENT_ID_LIST = []
-SAMPLE_SUBSET_LIST = []
+# memory budget of the write buffers of a process, split evenly across the filtered data files open at once
+OUTPUT_BUFFER_BUDGET = 16 * 1024 * 1024
+MIN_OUTPUT_BUFFER_SIZE = 16 * 1024
+MAX_OUTPUT_BUFFER_SIZE = 1024 * 1024
+
+# most filtered data files open at once, the least recently written one is closed to open another
+MAX_OPEN_WRITERS = 64
+OPEN_WRITERS = set()
+WRITE_CLOCK = itertools.count()
+
+
+class CaseIdIndex(object):
+	"""
+		Ordered set of case ids.
+		Membership checks are O(1) and iterating returns the case ids in the order they were added.
+	"""
+	def __init__(self, case_ids = None):
+		self.case_ids = []
+		self.case_id_set = set()
+		if case_ids != None:
+			self.extend(case_ids)
+
+	def add(self, case_id):
+		if case_id not in self.case_id_set:
+			self.case_id_set.add(case_id)
+			self.case_ids.append(case_id)
+
+	def extend(self, case_ids):
+		for case_id in case_ids:
+			self.add(case_id)
+
+	def __contains__(self, case_id):
+		return case_id in self.case_id_set
+
+	def __iter__(self):
+		return iter(self.case_ids)
+
+	def __len__(self):
+		return len(self.case_ids)
+
+
+class StudySubset(object):
+	""" Subset of a study: the subset identifier and the indexes of its samples and patients. """
+	def __init__(self, subset_id):
+		self.subset_id = subset_id
+		self.samples = CaseIdIndex()
+		self.patients = CaseIdIndex()
+
+
+class FilteredDataWriter(object):
+	"""
+		Buffered writer for the data of a file filtered for a subset.
+		Rows are written to a temp file as they are filtered, which is renamed to
+		the output file on commit or removed on discard. The output is gzipped if compressed.
+		At most MAX_OPEN_WRITERS temp files are open at once: the least recently written one
+		is closed when another has to be opened, and is reopened for appending on its next row.
+	"""
+	def __init__(self, filename, subset_id, header, compress = False):
+		self.filename = filename
+		self.output_filename = curation_io.get_output_filename(curation_io.get_uncompressed_filename(filename) + '.' + subset_id, compress, filename)
+		self.temp_filename = self.output_filename + '.tmp' + str(os.getpid())
+		self.output_file = None
+		self.created = False
+		self.finished = False
+		self.num_rows = 0
+		self.write(header)
+
+	def write(self, data):
+		if self.output_file == None:
+			self.open()
+		self.last_write = next(WRITE_CLOCK)
+		self.output_file.write(data)
+
+	def write_row(self, row):
+		self.write('\n' + row)
+		self.num_rows += 1
+
+	def open(self):
+		if len(OPEN_WRITERS) >= MAX_OPEN_WRITERS:
+			min(OPEN_WRITERS, key = lambda writer: writer.last_write).close()
+		self.output_file = curation_io.open_output_file(self.temp_filename, get_output_buffer_size(), self.output_filename, self.created)
+		self.created = True
+		OPEN_WRITERS.add(self)
+
+	def close(self):
+		if self.output_file != None:
+			OPEN_WRITERS.discard(self)
+			self.output_file.close()
+			self.output_file = None
+
+	def commit(self):
+		print 'Data successfully filtered for file:', self.filename
+		self.close()
+		os.rename(self.temp_filename, self.output_filename)
+		self.finished = True
+		curation_metrics.add_count('rows_written', self.num_rows)
+
+		print 'Filtered data written to:', self.output_filename
+		print
+
+	def discard(self):
+		if not self.finished:
+			self.close()
+			self.finished = True
+			if self.created:
+				os.remove(self.temp_filename)
+
+
+# subsets to filter the study into, by position and by identifier, and the subsets each sample or patient id belongs to
+SUBSETS = []
+SUBSETS_BY_ID = {}
+CASE_ID_SUBSETS = {}
+
+# chromosomal (chromosome, start, end) regions that segment files are restricted to, if any
+REGIONS = []
 
 NON_CASE_IDS = ['Hugo_Symbol', 'Entrez_Gene_Id']
 PROFILE_DATATYPE_FILENAMES = [
@@ -27,6 +148,12 @@ NORMAL_DATATYPE_FILENAMES = {
 }
 
 
+def get_output_buffer_size():
+	""" Returns the write buffer size of each filtered data file, splitting the budget across the files open at once. """
+	num_open_writers = max(1, min(len(SUBSETS), MAX_OPEN_WRITERS))
+	return max(MIN_OUTPUT_BUFFER_SIZE, min(MAX_OUTPUT_BUFFER_SIZE, OUTPUT_BUFFER_BUDGET / num_open_writers))
+
+
 def process_datum(value):
 	""" 
 		Strips leading/trailing whitespace from datum. 
@@ -39,195 +166,600 @@ def process_datum(value):
 	return vfixed
 
 
+def get_header_line(filename):
+	""" Gets the header line from the file, or None if the file has no header. """
+
+	header_line = None
+	data_file = curation_io.open_input_file(filename)
+	for line in data_file:
+		if not line.startswith('#'):
+			header_line = line
+			break
+	data_file.close()
+	return header_line
+
+
 def get_header(filename):
 	""" Gets the header from the file. """
 
-	filedata = [x for x in open(filename).read().split('\n') if not x.startswith("#")]
-	header = map(str.strip, filedata[0].split('\t'))
-	return header
+	header_line = get_header_line(filename)
+	if header_line == None:
+		return []
+	return map(str.strip, header_line.split('\t'))
 
 
-def filter_profile_data_file(filename, subset_id):
-	""" Filters profile data file sample subset list """
+def get_column_indices(header, columns):
+	"""
+		Returns the position of each column in the header.
+		Columns not found in the header get -1, which points at the empty
+		value appended to every split line by project_columns.
+	"""
+	header_index = {}
+	for i,hdr in enumerate(header):
+		header_index.setdefault(hdr, i)
+	return [header_index.get(column, -1) for column in columns]
 
-	# flag for indicating whether data was successfully filtered or not
-	filter_sucessful = True
 
-	# get header for subset data
-	subset_header = [hdr for hdr in get_header(filename) if hdr in NON_CASE_IDS]
-	non_case_id_count = len(subset_header)
-	subset_header.extend(SAMPLE_SUBSET_LIST[:])
+def split_line(line):
+	""" Splits the line into fields, with an empty value appended for columns missing from the header. """
+	fields = line.rstrip('\r\n').split('\t')
+	fields.append('')
+	return fields
 
-	# open data file and load data only for samples in subset list
-	data_file = open(filename, 'rU')
-	data_reader = csv.DictReader(data_file, dialect='excel-tab')
 
-	filtered_data = ['\t'.join(subset_header)]
-	for i,line in enumerate(data_reader):
-		# read data only for columns in new subset header
-		row_data = map(lambda x: line.get(x,''), subset_header)
+def project_columns(fields, column_indices):
+	""" Returns the values at the given column positions of the split line. """
+	try:
+		return [fields[i] for i in column_indices]
+	except IndexError:
+		# columns past the end of a short row are empty
+		return [fields[i] if i < len(fields) else '' for i in column_indices]
 
-		# count number of empty columns
-		non_empty_data = [val for val in row_data if val != '']
 
-		# make sure that row data is not empty, exit if true
-		if len(non_empty_data) <= non_case_id_count:
-			filter_sucessful = False
-			break
+def filter_profile_matrix(filename, matrix, compress = False):
+	"""
+		Filters profile data by the sample list of every subset using the memory-mapped matrix of the profile file.
+		Only the sample columns of each subset are read, and rows without data are found with a vectorized check.
+		Returns the identifiers of the subsets that could not be filtered.
+	"""
+	print 'Reading profile data using binary matrix for file:', filename
+	curation_metrics.add_count('matrix_files')
 
-		# clean up data values before concatenating and appending to filtered data list
-		processed_row_data = map(lambda x: process_datum(x), row_data)
-		filtered_data.append('\t'.join(processed_row_data))
-	data_file.close()
+	skipped_subset_ids = []
+	for subset in SUBSETS:
+		sample_indices = matrix.get_sample_indices(list(subset.samples))
 
-	# if filtering not successful then alert
-	if not filter_sucessful:
-		print 'ERROR: Data could not be filtered using given subset list - skipping file:', filename
-		print
-	else:
-		# write filtered data to file 
-		print 'Data successfully filtered for file:', filename
-		output_filename = filename + '.' + subset_id
-		output_file = open(output_filename, 'w')
-		output_file.write('\n'.join(filtered_data))
-		output_file.close()
-
-		print 'Filtered data written to:', output_filename
-		print
+		# if filtering not successful then alert
+		if not matrix.has_data_in_every_row(sample_indices, len(matrix.gene_header)):
+			print 'ERROR: Data could not be filtered using subset list', subset.subset_id, '- skipping file:', filename
+			print
+			skipped_subset_ids.append(subset.subset_id)
+			continue
 
+		writer = FilteredDataWriter(filename, subset.subset_id, '\t'.join(matrix.gene_header + list(subset.samples)), compress)
+		try:
+			for row_data in matrix.get_rows(sample_indices):
+				writer.write_row('\t'.join(row_data))
+			writer.commit()
+		finally:
+			writer.discard()
+	return skipped_subset_ids
 
-def filter_normal_data_file(filename, column, subset_id):
-	""" Filters data file by sample subset list using given case id column. """
 
-	# get header for subset data
+def filter_profile_data_file(filename, compress = False):
+	"""
+		Filters profile data file by the sample list of every subset.
+		The file is read once and each row is projected onto the columns of each subset.
+		If the file has an up to date binary matrix that stores it exactly then the matrix is used instead.
+		Returns the identifiers of the subsets that could not be filtered.
+	"""
+	matrix = profile_matrix.load_profile_matrix(filename)
+	if matrix != None and matrix.lossless:
+		return filter_profile_matrix(filename, matrix, compress)
+
+	# get header for each subset and resolve the position of each subset column once
 	header = get_header(filename)
+	non_case_id_header = [hdr for hdr in header if hdr in NON_CASE_IDS]
+	non_case_id_count = len(non_case_id_header)
+
+	subset_columns = []
+	writers = {}
+	try:
+		for subset in SUBSETS:
+			subset_header = non_case_id_header + list(subset.samples)
+			subset_columns.append((subset, get_column_indices(header, subset_header)))
+			writers[subset.subset_id] = FilteredDataWriter(filename, subset.subset_id, '\t'.join(subset_header), compress)
+
+		# open data file and load data only for samples in subset lists
+		data_file = curation_io.open_input_file(filename)
+		header_found = False
+
+		# subsets are dropped from filtering once a row has no data for any of their samples
+		failed_subsets = []
+		for line in data_file:
+			# skip commented lines, the header and blank lines
+			if line.startswith('#'):
+				continue
+			if not header_found:
+				header_found = True
+				continue
+			if not line.rstrip('\r\n'):
+				continue
+
+			fields = split_line(line)
+			for subset,column_indices in subset_columns:
+				# read data only for columns in new subset header
+				row_data = project_columns(fields, column_indices)
+
+				# make sure that row data is not empty, stop filtering subset if true
+				if len(row_data) - row_data.count('') <= non_case_id_count:
+					failed_subsets.append(subset)
+					writers[subset.subset_id].discard()
+					continue
+
+				# clean up data values before concatenating and writing to filtered data file
+				writers[subset.subset_id].write_row('\t'.join([val.strip() for val in row_data]))
+
+			if failed_subsets:
+				subset_columns = [(subset,column_indices) for subset,column_indices in subset_columns if subset not in failed_subsets]
+				if not subset_columns:
+					break
+		data_file.close()
+
+		skipped_subset_ids = []
+		for subset in SUBSETS:
+			# if filtering not successful then alert
+			if subset in failed_subsets:
+				print 'ERROR: Data could not be filtered using subset list', subset.subset_id, '- skipping file:', filename
+				print
+				skipped_subset_ids.append(subset.subset_id)
+			else:
+				writers[subset.subset_id].commit()
+	finally:
+		# remove the temp files of subsets left unfinished by an error
+		for writer in writers.values():
+			writer.discard()
+	return skipped_subset_ids
 
-	# open data file and load data only for samples in subset list
-	data_file = open(filename, 'rU')
-	data_reader = csv.DictReader(data_file, dialect='excel-tab')
 
-	filtered_data = ['\t'.join(header)]
-	for i,line in enumerate(data_reader):
-		# skip row of data if sample id not in sample subset list
-		if line[column] in SAMPLE_SUBSET_LIST or line[column] in PATIENT_ID_LIST:			
-			row_data = map(lambda x: line.get(x,''), header)
+def read_region_segment_rows(filename, column, header):
+	"""
+		Yields (case id, row data) for the rows of the segment file that overlap the regions.
+		If the file has an up to date segment index then only the overlapping rows are read,
+		seeking directly to them.
+	"""
+	segment_index = None
+	if not curation_io.is_compressed(filename):
+		segment_index = segment_interval_index.load_segment_index(filename, REGIONS)
+
+	if segment_index != None:
+		print 'Reading segments overlapping', len(REGIONS), 'regions using segment index for file:', filename
+		curation_metrics.add_count('indexed_files')
+		lines = segment_interval_index.read_region_rows(filename, segment_index, REGIONS)
+	else:
+		data_file = curation_io.open_input_file(filename)
+		lines = (line for line in data_file if not line.startswith('#'))
+		next(lines, None)
+
+	column_index = header.index(column) if column in header else -1
+	for line in lines:
+		line_data = line.rstrip('\r\n').split('\t')
+		if not segment_interval_index.segment_overlaps(segment_interval_index.get_segment_position(line_data), REGIONS):
+			continue
+		case_id = line_data[column_index] if 0 <= column_index < len(line_data) else ''
+		yield case_id, line_data[:len(header)] + [''] * (len(header) - len(line_data))
 
-			# clean up data values before concatenating and appending to filtered data list
-			processed_row_data = map(lambda x: process_datum(x), row_data)
-			filtered_data.append('\t'.join(processed_row_data))
-	data_file.close()
+	if segment_index == None:
+		data_file.close()
 
-	# if filtering not successful then alert
-	if len(filtered_data) == 1:
-		print 'ERROR: Data could not be filtered using given subset list - skipping file:', filename
-		print
+
+def read_normal_data_rows(filename, column, header):
+	"""
+		Yields (case id, row data) for the rows of the data file.
+		If the file has an up to date case id index then only the rows of the
+		subset case ids are read, seeking directly to them. Segment files are
+		restricted to the regions, if any. Rows are parsed the same way whether
+		or not they are read through the index.
+	"""
+	if REGIONS and curation_io.get_uncompressed_filename(filename).endswith('.seg'):
+		for case_id,row_data in read_region_segment_rows(filename, column, header):
+			yield case_id, row_data
+		return
+
+	data_file = None
+	case_id_ranges = case_id_index.load_case_id_index(filename, column, CASE_ID_SUBSETS)
+	if case_id_ranges != None:
+		print 'Reading rows for', len(case_id_ranges), 'case ids using case id index for file:', filename
+		curation_metrics.add_count('indexed_files')
+		lines = itertools.chain([get_header_line(filename)], (line for case_id,line in case_id_index.read_case_id_rows(filename, case_id_ranges)))
 	else:
-		# write filtered data to file 
-		print 'Data successfully filtered for file:', filename
-		output_filename = filename + '.' + subset_id
-		output_file = open(output_filename, 'w')
-		output_file.write('\n'.join(filtered_data))
-		output_file.close()
-
-		print 'Filtered data written to:', output_filename
-		print
+		# open data file and load data for every row, skipping commented lines (i.e., MAF version line)
+		data_file = curation_io.open_input_file(filename)
+		lines = (x for x in data_file if not x.startswith('#'))
+
+	data_reader = csv.DictReader(lines, dialect='excel-tab')
+	for line in data_reader:
+		yield process_datum(line[column]), map(lambda x: line.get(x,''), header)
+	if data_file != None:
+		data_file.close()
+
+
+def filter_normal_data_file(filename, column, compress = False):
+	"""
+		Filters data file by the sample and patient lists of every subset using given case id column.
+		The file is read once and each row is routed to every subset that its case id belongs to.
+		Returns the identifiers of the subsets that could not be filtered.
+	"""
+
+	# get header for subset data
+	header = get_header(filename)
+	writers = {}
+	try:
+		for subset in SUBSETS:
+			writers[subset.subset_id] = FilteredDataWriter(filename, subset.subset_id, '\t'.join(header), compress)
+
+		for case_id,row_data in read_normal_data_rows(filename, column, header):
+			# skip row of data if case id not in any subset
+			subsets = CASE_ID_SUBSETS.get(case_id)
+			if subsets:
+				# clean up data values before concatenating and writing to filtered data files
+				processed_row_data = '\t'.join(map(lambda x: process_datum(x), row_data))
+				for subset in subsets:
+					writers[subset.subset_id].write_row(processed_row_data)
+
+		skipped_subset_ids = []
+		for subset in SUBSETS:
+			# if filtering not successful then alert
+			if writers[subset.subset_id].num_rows == 0:
+				print 'ERROR: Data could not be filtered using subset list', subset.subset_id, '- skipping file:', filename
+				print
+				skipped_subset_ids.append(subset.subset_id)
+			else:
+				writers[subset.subset_id].commit()
+	finally:
+		# remove the temp files of subsets that were not filtered or were left unfinished by an error
+		for writer in writers.values():
+			writer.discard()
+	return skipped_subset_ids
 
 
-def filter_study_by_subset_main(input_directory, subset_id):
-	""" Filters study by sample subset list provided. """
-	for filename in os.listdir(input_directory):
+def get_study_file_tasks(input_directory):
+	"""
+		Returns the (filename, case id column) of every data file in the study to filter, sorted by filename.
+		Compressed data files are matched by their name without the .gz or .bgz extension.
+	"""
+	tasks = []
+	for filename in sorted(os.listdir(input_directory)):
+		filename_path = os.path.join(input_directory, filename)
+
 		# skip sub-directories
-		if os.path.isdir(filename) or 'meta_' in filename:
+		if os.path.isdir(filename_path) or 'meta_' in filename:
 			print 'Skipping sub-directory or meta file:', filename
 			print
 			continue
 
-		if len(SAMPLE_SUBSET_LIST) == 0:
-			print 'ERROR: sample subset list got deleted'
-			sys.exit(2)
-
-		filename_path = os.path.join(input_directory, filename)
-		if filename in PROFILE_DATATYPE_FILENAMES:
-			print 'Processing data from file:', filename
-			filter_profile_data_file(filename_path, subset_id)
+		data_filename = curation_io.get_uncompressed_filename(filename)
+		if data_filename in PROFILE_DATATYPE_FILENAMES:
+			tasks.append((filename_path, None))
 
-		elif filename in NORMAL_DATATYPE_FILENAMES.keys() or filename.endswith('.seg'):
+		elif data_filename in NORMAL_DATATYPE_FILENAMES.keys() or data_filename.endswith('.seg'):
 			# get case id column name
-			if filename.endswith('.seg'):
+			if data_filename.endswith('.seg'):
 				column = 'ID'
 			else:
-				column = NORMAL_DATATYPE_FILENAMES[filename]
-
-			print 'Processing data from file:', filename, 'using column:', column
-			filter_normal_data_file(filename_path, column, subset_id)
+				column = NORMAL_DATATYPE_FILENAMES[data_filename]
+			tasks.append((filename_path, column))
 		else:
 			print 'Skipping unknown filename pattern:', filename
-		print
+			print
+	return tasks
+
+
+def filter_study_file(filename_path, column, compress):
+	"""
+		Filters a data file from the study by its case id column, or as a profile data file if the column is None,
+		and returns (status, message). The status is 'filtered', or 'skipped' if the file could not be filtered for some subsets.
+	"""
+	if column == None:
+		print 'Processing data from file:', os.path.basename(filename_path)
+		with curation_metrics.stage('filter_profile_data'):
+			skipped_subset_ids = filter_profile_data_file(filename_path, compress)
+	else:
+		print 'Processing data from file:', os.path.basename(filename_path), 'using column:', column
+		with curation_metrics.stage('filter_normal_data'):
+			skipped_subset_ids = filter_normal_data_file(filename_path, column, compress)
+	curation_metrics.add_file_size('input_bytes', filename_path)
+
+	if skipped_subset_ids:
+		return 'skipped', 'not filtered for subsets: ' + ', '.join(skipped_subset_ids)
+	return 'filtered', ''
+
+
+def init_filter_worker(subsets, case_id_subsets, regions, output_buffer_budget):
+	""" Sets the subsets, regions and share of the output buffer budget in a filtering worker process. """
+	global OUTPUT_BUFFER_BUDGET
+	OUTPUT_BUFFER_BUDGET = output_buffer_budget
+	# copy first - forked workers may be handed the module globals themselves
+	subsets = list(subsets)
+	case_id_subsets = dict(case_id_subsets)
+	regions = list(regions)
+	del REGIONS[:]
+	REGIONS.extend(regions)
+	del SUBSETS[:]
+	SUBSETS.extend(subsets)
+	SUBSETS_BY_ID.clear()
+	SUBSETS_BY_ID.update([(subset.subset_id, subset) for subset in subsets])
+	CASE_ID_SUBSETS.clear()
+	CASE_ID_SUBSETS.update(case_id_subsets)
+
+
+def filter_study_by_subset_main(input_directory, jobs = 1, compress = False):
+	"""
+		Filters study by sample subset lists provided.
+		With more than one job, data files are filtered in parallel across a process pool
+		and the output buffer budget is split evenly across the jobs.
+		Filtered data files are gzipped if compress is set.
+		Returns the (filename, status, message) result of each data file.
+	"""
+	if len(SUBSETS) == 0:
+		print 'ERROR: sample subset list got deleted'
+		sys.exit(2)
+
+	tasks = [(filename, column, compress) for filename,column in get_study_file_tasks(input_directory)]
+	return curation_io.run_file_tasks(filter_study_file, tasks, jobs, init_filter_worker, (SUBSETS, CASE_ID_SUBSETS, REGIONS, OUTPUT_BUFFER_BUDGET / jobs))
 
 
-def generate_patient_subset_list(input_directory):
-	""" Generates list of patients using  """
+def get_clinical_filenames(input_directory):
+	""" Returns the clinical files of the study, which may be compressed, by their uncompressed filename. """
+	return dict([(curation_io.get_uncompressed_filename(filename), filename) for filename in os.listdir(input_directory) if 'data_clinical' in filename])
 
-	# determine which clinical filename to use for generating list of patients from sample subset list
-	clinical_filenames = [filename for filename in os.listdir(input_directory) if 'data_clinical' in filename]
+
+def get_clinical_sample_filename(input_directory):
+	""" Returns the clinical file with the sample and patient ids of the study. """
+	clinical_filenames = get_clinical_filenames(input_directory)
 	if len(clinical_filenames) == 0:
 		print 'ERROR: No clinical data files found in:', input_directory
 		sys.exit(2)
 	if 'data_clinical.txt' in clinical_filenames:
-		clinical_filename = os.path.join(input_directory, 'data_clinical.txt')
+		clinical_filename = os.path.join(input_directory, clinical_filenames['data_clinical.txt'])
 	else:
-		clinical_filename = os.path.join(input_directory, 'data_clinical_sample.txt')
+		clinical_filename = os.path.join(input_directory, clinical_filenames.get('data_clinical_sample.txt', 'data_clinical_sample.txt'))
+	return clinical_filename
+
+
+def index_subset_patients():
+	""" Adds the patients of every subset to the subsets that their patient id belongs to. """
+	for subset in SUBSETS:
+		for patient_id in subset.patients:
+			patient_subsets = CASE_ID_SUBSETS.setdefault(patient_id, [])
+			if subset not in patient_subsets:
+				patient_subsets.append(subset)
+
+
+def generate_patient_subset_lists(input_directory):
+	""" Generates list of patients for every subset in one pass over the clinical file. """
+
+	# determine which clinical filename to use for generating list of patients from sample subset lists
+	clinical_filename = get_clinical_sample_filename(input_directory)
 
 	# open clinical file and generate list of patient ids
-	clin_file = open(clinical_filename, 'rU')
+	clin_file = curation_io.open_input_file(clinical_filename)
 	clin_reader = csv.DictReader(clin_file, dialect='excel-tab')
 	for line in clin_reader:
-		if line['SAMPLE_ID'] in SAMPLE_SUBSET_LIST and not line['PATIENT_ID'] in PATIENT_ID_LIST:
-			PATIENT_ID_LIST.append(line['PATIENT_ID'])
+		for subset in CASE_ID_SUBSETS.get(line['SAMPLE_ID'], []):
+			subset.patients.add(line['PATIENT_ID'])
 	clin_file.close()
 
+	index_subset_patients()
+
+
+def add_subset_sample(subset_id, sample_id):
+	""" Adds the sample to the subset, creating the subset if it doesn't exist yet. """
+	subset = SUBSETS_BY_ID.get(subset_id)
+	if subset == None:
+		subset = StudySubset(subset_id)
+		SUBSETS.append(subset)
+		SUBSETS_BY_ID[subset_id] = subset
 
-def load_sample_subset_list(input_directory, subset_filename):
+	if sample_id not in subset.samples:
+		subset.samples.add(sample_id)
+		CASE_ID_SUBSETS.setdefault(sample_id, []).append(subset)
+
+
+def load_sample_subset_list(input_directory, subset_filename, subset_id):
 	""" Loads subset list from given file. """
 
 	subset_file = open(subset_filename, 'rU')	
-	SAMPLE_SUBSET_LIST.extend(map(str.strip, subset_file.read().split('\n')))
+	for sample_id in map(str.strip, subset_file.read().split('\n')):
+		if sample_id:
+			add_subset_sample(subset_id, sample_id)
 	subset_file.close()
 
 	# generate patient subset list 
-	generate_patient_subset_list(input_directory)
+	generate_patient_subset_lists(input_directory)
+
+
+def load_subset_manifest(input_directory, manifest_filename):
+	"""
+		Loads subset lists from a manifest of subset identifier and sample id pairs.
+		The manifest is tab-delimited with one SUBSET_ID, SAMPLE_ID pair per line.
+	"""
+
+	manifest_file = open(manifest_filename, 'rU')
+	for line in manifest_file:
+		line_data = map(str.strip, line.split('\t'))
+		if line.startswith('#') or not line_data[0] or line_data[:2] == ['SUBSET_ID', 'SAMPLE_ID']:
+			continue
+		if len(line_data) < 2 or not line_data[1]:
+			print 'ERROR: Invalid line in subset manifest - expected subset identifier and sample id:', line.strip()
+			sys.exit(2)
+		add_subset_sample(line_data[0], line_data[1])
+	manifest_file.close()
+	print 'Loaded', len(SUBSETS), 'subsets from manifest:', manifest_filename
+
+	# generate patient subset lists
+	generate_patient_subset_lists(input_directory)
+
+
+def load_clinical_columns(filename, case_id_column, attributes):
+	"""
+		Returns the case ids and the columns of the attributes found in the clinical file (attribute -> list of values),
+		read in one pass over the file.
+	"""
+	header = get_header(filename)
+	attributes = [attribute for attribute in attributes if attribute in header]
+	column_indices = get_column_indices(header, [case_id_column] + attributes)
+
+	rows = []
+	data_file = curation_io.open_input_file(filename)
+	header_found = False
+	for line in data_file:
+		# skip commented lines (i.e., clinical attribute metadata), the header and blank lines
+		if line.startswith('#'):
+			continue
+		if not header_found:
+			header_found = True
+			continue
+		if not line.rstrip('\r\n'):
+			continue
+		rows.append([val.strip() for val in project_columns(split_line(line), column_indices)])
+	data_file.close()
+
+	columns = zip(*rows) if rows else [()] * len(column_indices)
+	return list(columns[0]), dict(zip(attributes, map(list, columns[1:])))
+
+
+def load_subset_predicate(input_directory, predicate, subset_id):
+	"""
+		Loads the subset of samples matching the clinical attribute predicate, i.e.
+		'ONCOTREE_CODE in (LUAD,LUSC) and GENOMIC_ALTERATIONS>10'.
+		The predicate is evaluated one attribute column at a time over the clinical sample file,
+		with patient attributes taken from the clinical patient file, and the sample and patient
+		lists of the subset are built in the same pass.
+	"""
+	try:
+		predicate_tree = subset_predicate.compile_predicate(predicate)
+	except ValueError as e:
+		print 'ERROR: Invalid subset predicate:', e
+		sys.exit(2)
+	attributes = subset_predicate.get_predicate_attributes(predicate_tree)
+
+	# load the sample and patient ids and the attribute columns from the clinical sample file
+	clinical_filename = get_clinical_sample_filename(input_directory)
+	sample_ids,columns = load_clinical_columns(clinical_filename, 'SAMPLE_ID', ['PATIENT_ID'] + attributes)
+	if 'PATIENT_ID' not in columns:
+		print 'ERROR: Could not find PATIENT_ID column in:', clinical_filename
+		sys.exit(2)
+	patient_ids = columns['PATIENT_ID']
+
+	# patient attributes are looked up in the clinical patient file by patient id
+	patient_attributes = [attribute for attribute in attributes if attribute not in columns]
+	patient_filename = get_clinical_filenames(input_directory).get('data_clinical_patient.txt')
+	if patient_attributes and patient_filename != None:
+		patient_filename = os.path.join(input_directory, patient_filename)
+		patients,patient_columns = load_clinical_columns(patient_filename, 'PATIENT_ID', patient_attributes)
+		for attribute,values in patient_columns.items():
+			patient_values = dict(zip(patients, values))
+			columns[attribute] = [patient_values.get(patient_id, '') for patient_id in patient_ids]
+
+	missing_attributes = [attribute for attribute in attributes if attribute not in columns]
+	if missing_attributes:
+		print 'ERROR: Clinical attributes in subset predicate not found in clinical files:', ', '.join(missing_attributes)
+		sys.exit(2)
+
+	try:
+		matches = subset_predicate.evaluate_predicate(predicate_tree, columns)
+	except ValueError as e:
+		print 'ERROR: Invalid subset predicate:', e
+		sys.exit(2)
+	for sample_id,patient_id,match in zip(sample_ids, patient_ids, matches):
+		if match and sample_id:
+			add_subset_sample(subset_id, sample_id)
+			SUBSETS_BY_ID[subset_id].patients.add(patient_id)
+
+	if subset_id not in SUBSETS_BY_ID:
+		print 'ERROR: No samples matched subset predicate:', predicate
+		sys.exit(2)
+	print 'Subset predicate matched', len(SUBSETS_BY_ID[subset_id].samples), 'of', len(sample_ids), 'samples.'
+	index_subset_patients()
+
 
 def usage():
-	print >> OUTPUT_FILE, 'filter_study_by_subset.py --subset-file path/to/subset/file --subset-identifier identifier_for_subset [default=filtered] --input-directory path/to/input/directory'
+	print >> OUTPUT_FILE, 'filter_study_by_subset.py ((--subset-file path/to/subset/file | --subset-predicate "ONCOTREE_CODE in (LUAD,LUSC) and GENOMIC_ALTERATIONS>10") --subset-identifier identifier_for_subset [default=filtered] | --subset-manifest path/to/subset/manifest) --input-directory path/to/input/directory [--regions chr:start-end,... | path/to/regions/file] [--jobs N] [--compress-output] [--metrics-json path/to/metrics.json]'
 
 def main():
 	parser = optparse.OptionParser()
 	parser.add_option('-f', '--subset-file', action = 'store', dest = 'subsetfile')
 	parser.add_option('-s', '--subset-identifier', action='store', dest='subsetid')
+	parser.add_option('-p', '--subset-predicate', action='store', dest='subsetpredicate')
+	parser.add_option('-m', '--subset-manifest', action='store', dest='subsetmanifest')
 	parser.add_option('-i', '--input-directory', action='store', dest='inputdir')
+	parser.add_option('-r', '--regions', action='store', dest='regions')
+	parser.add_option('-j', '--jobs', action='store', dest='jobs', type='int', default=1)
+	parser.add_option('-z', '--compress-output', action='store_true', dest='compressoutput', default=False)
+	parser.add_option('--metrics-json', action='store', dest='metricsjson')
 
 	(options, args) = parser.parse_args()
+	curation_metrics.enable_metrics('filter_study_by_subset', options.metricsjson)
 
 	subset_filename = options.subsetfile
 	subset_id = options.subsetid
+	manifest_filename = options.subsetmanifest
+	predicate = options.subsetpredicate
 	input_directory = options.inputdir
+	jobs = options.jobs
+	compress_output = options.compressoutput
+	regions = options.regions
 
-	if not os.path.exists(subset_filename):
-		print 'No such file or directory:', subset_filename
+	if input_directory == None:
+		usage()
 		sys.exit(2)
 
-	if not os.path.exists(input_directory):
-		print 'No such file or directory:', input_directory
+	if jobs < 1:
+		print 'ERROR: Invalid number of jobs:', jobs
 		sys.exit(2)
 
-	if not subset_id:
+	if [subset_filename, manifest_filename, predicate].count(None) != 2:
+		print 'ERROR: Exactly one of a subset file, a subset manifest or a subset predicate must be given.'
+		usage()
+		sys.exit(2)
+
+	for filename in [subset_filename, manifest_filename, input_directory]:
+		if filename != None and not os.path.exists(filename):
+			print 'No such file or directory:', filename
+			sys.exit(2)
+
+	if manifest_filename == None and not subset_id:
 		print 'No subset identifier entered - using default value "filtered"'
+		subset_id = 'filtered'
+
+	# restrict segment files to the chromosomal regions given
+	if regions != None:
+		try:
+			REGIONS.extend(segment_interval_index.load_regions(regions))
+		except ValueError as e:
+			print 'ERROR: Invalid regions:', e
+			sys.exit(2)
+		if not REGIONS:
+			print 'ERROR: No regions found in:', regions
+			sys.exit(2)
+		print 'Restricting segment files to', len(REGIONS), 'regions.'
+
+	# load sample subset lists from file
+	with curation_metrics.stage('load_subset'):
+		if manifest_filename != None:
+			load_subset_manifest(input_directory, manifest_filename)
+		elif predicate != None:
+			load_subset_predicate(input_directory, predicate, subset_id)
+		else:
+			load_sample_subset_list(input_directory, subset_filename, subset_id)
 
-	# load sample subset list from file
-	load_sample_subset_list(input_directory, subset_filename)
+	# filter study by samples in subset lists
+	with curation_metrics.stage('filter_study'):
+		results = filter_study_by_subset_main(input_directory, jobs, compress_output)
 
-	# filter study by samples in subset list
-	filter_study_by_subset_main(input_directory, subset_id)
+	if curation_io.print_file_results(results, 'Filtering', 'data files'):
+		sys.exit(2)
 
 
 if __name__ == '__main__':
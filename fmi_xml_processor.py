@@ -2,56 +2,269 @@ import sys
 import os
 import argparse
 import re
-import xml.etree.ElementTree as ET
-from StringIO import StringIO
+import json
+import xml.etree.ElementTree as ElementTree
+try:
+	import xml.etree.cElementTree as cElementTree
+except ImportError:
+	cElementTree = None
+try:
+	from lxml import etree as lxml_etree
+except ImportError:
+	lxml_etree = None
 
+import curation_metrics
+import curation_io
 
-def fmi_xml_processor(filename,output_directory):
+# XML backends that can parse the XML files, fastest first - the ElementTree API used to parse and restructure
+# the variant reports is set along with the backend by set_xml_backend()
+XML_BACKENDS = ['celementtree', 'lxml', 'elementtree']
+XML_BACKEND = 'elementtree'
+ET = ElementTree
 
+# manifest of the input files processed into the output directory, with the content hash, size and mtime of each input
+MANIFEST_FILENAME = 'fmi_xml_processor.manifest'
+MANIFEST_VERSION = 2
+
+# attributes filled in with an empty value when missing from the elements of each variant report section
+VARIANT_SECTION_ATTRIBUTES = {
+	'short-variants':('short-variant', ['depth']),
+	'copy-number-alterations':('copy-number-alteration', []),
+	'rearrangements':('rearrangement', [])
+}
+
+
+def strip_namespaces(element):
+	""" Strips the namespace from the tag of the element and all of its descendants. """
+	for el in element.iter():
+		if is_element(el) and '}' in el.tag:
+			el.tag = el.tag.split('}', 1)[1]
+
+
+def get_available_xml_backends():
+	""" Returns the XML backends that are installed, fastest first. """
+	available = []
+	if cElementTree != None:
+		available.append('celementtree')
+	if lxml_etree != None:
+		available.append('lxml')
+	available.append('elementtree')
+	return available
+
+
+def set_xml_backend(backend = 'auto'):
+	"""
+		Sets the XML backend used to parse, restructure and serialize the XML files and returns its name,
+		'auto' picks the fastest installed one. Every backend writes byte-identical output.
+	"""
+	global XML_BACKEND, ET
+	available = get_available_xml_backends()
+	if backend == 'auto':
+		backend = available[0]
+	if backend not in available:
+		raise ValueError('XML backend is not installed: ' + backend)
+
+	XML_BACKEND = backend
+	if backend == 'lxml':
+		ET = lxml_etree
+	elif backend == 'celementtree':
+		ET = cElementTree
+	else:
+		ET = ElementTree
+	return backend
+
+
+def iterparse_xml(xml_file):
+	""" Returns the iterator over the start and end events of the XML file from the XML backend. """
+	if XML_BACKEND == 'lxml':
+		return lxml_etree.iterparse(xml_file, events = ('start', 'end'), huge_tree = True)
+	return ET.iterparse(xml_file, events = ('start', 'end'))
+
+
+def is_element(element):
+	""" Returns whether the element is an element, rather than a comment or processing instruction parsed by lxml. """
+	return isinstance(element.tag, basestring)
+
+
+def serialize_element(element, write):
+	"""
+		Writes the element with the same output as ElementTree.tostring(), for both ElementTree and lxml elements.
+		lxml comments and processing instructions are left out as the ElementTree parser leaves them out.
+		Returns False if the element has namespaced tags or attributes, which only ElementTree.tostring() can write.
+	"""
+	if not is_element(element):
+		if element.tail:
+			write(ElementTree._escape_cdata(element.tail, 'us-ascii'))
+		return True
+
+	tag = element.tag
+	if '}' in tag:
+		return False
+	write('<' + tag)
+	for key,value in sorted(element.items()):
+		if '}' in key:
+			return False
+		write(' %s="%s"' % (key, ElementTree._escape_attrib(value, 'us-ascii')))
+
+	text = element.text
+	if text or [child for child in element if is_element(child) or child.tail]:
+		write('>')
+		if text:
+			write(ElementTree._escape_cdata(text, 'us-ascii'))
+		for child in element:
+			if not serialize_element(child, write):
+				return False
+		write('</' + tag + '>')
+	else:
+		write(' />')
+	if element.tail:
+		write(ElementTree._escape_cdata(element.tail, 'us-ascii'))
+	return True
+
+
+def copy_to_element_tree(element):
+	""" Copies the element and its descendants to an ElementTree element, joining the text around any lxml comments. """
+	copy = ElementTree.Element(element.tag, dict(element.items()))
+	copy.text = element.text
+	copy.tail = element.tail
+	for child in element:
+		if is_element(child):
+			copy.append(copy_to_element_tree(child))
+		elif child.tail:
+			if len(copy) > 0:
+				copy[-1].tail = (copy[-1].tail or '') + child.tail
+			else:
+				copy.text = (copy.text or '') + child.tail
+	return copy
+
+
+def write_variant_report(output_file, variant_report, fill_counts):
+	""" Restructures the variant report into a Case element and writes it to the output file. """
+	strip_namespaces(variant_report)
+	for case_element in generate_multi_case_tree([variant_report], fill_counts).find('Cases'):
+		data = []
+		if not serialize_element(case_element, data.append):
+			data = [ElementTree.tostring(copy_to_element_tree(case_element))]
+		output_file.write(''.join(data))
+
+
+def print_fill_counts(fill_counts):
+	""" Prints the number of elements in each variant section and the number of missing values that were filled in. """
+	added = [(name, count) for name,count in sorted(fill_counts.items()) if '.' in name or name in ['pipeline-version', 'non-human-content']]
+	for element_tag,attributes in sorted(VARIANT_SECTION_ATTRIBUTES.values()):
+		print 'Processed', fill_counts.get(element_tag, 0), element_tag, 'elements.'
+	for name,count in added:
+		print 'Added', name, 'to', count, 'elements.'
+
+
+def fmi_xml_processor(filename, output_directory):
+	"""
+		Strips namespaces from the FoundationOne XML and restructures each variant report into a Case element in a single pass.
+		Each variant report is written out as soon as it has been parsed and is then cleared, so memory use stays flat
+		regardless of the number of cases in the file.
+	"""
 	print 'Processing filename:', filename
 
-	tree = ET.parse(filename)
-	root = tree.getroot()
-	variant_report_list = root.getchildren()
-	
-	new_tree = generate_multi_case_tree(variant_report_list)
+	output_filename = os.path.join(output_directory, os.path.basename(curation_io.get_uncompressed_filename(filename)))
+	temp_output_filename = output_filename + '.tmp' + str(os.getpid())
+	xml_file = curation_io.open_input_file(filename)
+	output_file = open(temp_output_filename, 'w')
+	output_file.write('<ClientCaseInfo>')
+
+	num_cases = 0
+	fill_counts = {}
+	depth = 0
+	root = None
+	variant_report = None
+	try:
+		for event,element in iterparse_xml(xml_file):
+			if event == 'start':
+				if root == None:
+					root = element
+				depth += 1
+				continue
+
+			# every child of the root element is a variant report
+			depth -= 1
+			if depth > 1:
+				continue
+
+			# a variant report is only written once the next one or the root has ended, so that the text after it
+			# has been parsed and the output does not depend on where the parser's input chunks happen to end
+			if variant_report != None:
+				# drop the variant report from the root before it is moved into its Case element
+				root.remove(variant_report)
+				if num_cases == 0:
+					output_file.write('<Cases>')
+				write_variant_report(output_file, variant_report, fill_counts)
+				num_cases += 1
+			variant_report = element if depth == 1 else None
+	except:
+		output_file.close()
+		os.remove(temp_output_filename)
+		raise
+	finally:
+		xml_file.close()
 
-	output_filename = os.path.join(output_directory, os.path.basename(filename))
-	output_file = ET.ElementTree(new_tree)
-	output_file.write(output_filename)
+	if num_cases == 0:
+		output_file.write('<Cases /></ClientCaseInfo>')
+	else:
+		output_file.write('</Cases></ClientCaseInfo>')
+	output_file.close()
+	os.rename(temp_output_filename, output_filename)
+	curation_metrics.add_count('cases', num_cases)
+	for name,count in sorted(fill_counts.items()):
+		curation_metrics.add_count(name, count)
+	print_fill_counts(fill_counts)
 
 	print 'Processed xml written to:', output_filename
+	return output_filename
 
-def generate_multi_case_tree(variant_report_list):
+def generate_multi_case_tree(variant_report_list, fill_counts = None):
 	tree = ET.Element('ClientCaseInfo')
 	root = ET.SubElement(tree, 'Cases')
 
+	if fill_counts == None:
+		fill_counts = {}
 	for variant_report in variant_report_list:
 		case,data = get_case_data(variant_report)
 		variant_report.attrib['test-request'] = case
-		variant_report = process_variant_report(root, variant_report)
+		variant_report = process_variant_report(variant_report, fill_counts)
 		case_element = ET.SubElement(root, 'Case', data)
 		case_element.append(variant_report)
 
 	return tree
 
-def process_variant_report(root, variant_report):
-	if not 'non-human-content' in variant_report.getchildren():
-		print 'Adding non-human content'
-		non_human_content = ET.SubElement(root, 'non-human-content', {})
-		variant_report.append(non_human_content)
+def process_variant_report(variant_report, fill_counts):
+	"""
+		Fills in the missing non-human-content element and pipeline-version attribute of the variant report,
+		and the missing attributes of the elements of each variant section, in place and in one pass.
+		The number of elements and filled in values are added to the fill counts.
+	"""
 	if not 'pipeline-version' in variant_report.keys():
-		print 'Adding pipeline version'
 		variant_report.attrib['pipeline-version'] = ''
+		fill_counts['pipeline-version'] = fill_counts.get('pipeline-version', 0) + 1
+
+	has_non_human_content = False
+	for section in variant_report:
+		if section.tag == 'non-human-content':
+			has_non_human_content = True
+		if section.tag not in VARIANT_SECTION_ATTRIBUTES:
+			continue
 
-	short_variants = variant_report.find('short-variants')
-	for i,short_variant in enumerate(variant_report.find('short-variants').getchildren()):
-		new_short_variant = short_variant
-		if not 'depth' in short_variant.keys():
-			print 'Adding depth to short variant'
-			new_short_variant.attrib['depth'] = ''
-		variant_report.find('short-variants').remove(short_variant)
-		variant_report.find('short-variants').append(new_short_variant)
+		element_tag,attributes = VARIANT_SECTION_ATTRIBUTES[section.tag]
+		for element in section:
+			if element.tag != element_tag:
+				continue
+			fill_counts[element_tag] = fill_counts.get(element_tag, 0) + 1
+			for attribute in attributes:
+				if attribute not in element.attrib:
+					element.attrib[attribute] = ''
+					fill_counts[element_tag + '.' + attribute] = fill_counts.get(element_tag + '.' + attribute, 0) + 1
+
+	if not has_non_human_content:
+		ET.SubElement(variant_report, 'non-human-content', {})
+		fill_counts['non-human-content'] = fill_counts.get('non-human-content', 0) + 1
 	return variant_report
 
 
@@ -82,23 +295,117 @@ def get_data_filenames(data_directory):
 	return case_filenames,output_directory
 
 
-def cleanup_xml_file(output_directory, filename):
-	output_filename = os.path.join(output_directory, filename)
-	tree = ET.parse(filename)
-	root = tree.getroot()
+def process_xml_file(filename, output_directory):
+	""" Processes an XML file into the output directory and returns ('processed', output filename). """
+	print 'Using XML backend:', XML_BACKEND
+	with curation_metrics.stage('process_xml'):
+		output_filename = fmi_xml_processor(filename, output_directory)
+	curation_metrics.add_count('files')
+	curation_metrics.add_file_size('input_bytes', filename)
+	curation_metrics.add_file_size('output_bytes', output_filename)
+	return 'processed', output_filename
 
-	it = ET.iterparse(StringIO(ET.tostring(root)))
-	for _, el in it:
-		if '}' in el.tag:
-			el.tag = el.tag.split('}', 1)[1]  # strip all namespaces
-	root = it.root	
 
-	ntree = ET.Element('ClientCaseInfo')
-	ntree.extend(root.getchildren())
-	output = ET.ElementTree(ntree)
-	output.write(output_filename)
-	print 'File written to: ' + output_filename
-	return output_filename
+def get_xml_filenames(data_directory):
+	""" Returns the XML files in the data directory, sorted by filename. """
+	return [os.path.join(data_directory, fname) for fname in sorted(os.listdir(data_directory)) if curation_io.get_uncompressed_filename(fname).endswith('.xml')]
+
+
+def load_manifest(output_directory):
+	"""
+		Returns the manifest entries of the input files processed into the output directory by input filename.
+		Empty if there is no manifest or it was written by a version that produced different output.
+	"""
+	manifest_filename = os.path.join(output_directory, MANIFEST_FILENAME)
+	if not os.path.exists(manifest_filename):
+		print 'No manifest from a previous run found - processing all XML files.'
+		return {}
+
+	manifest_file = open(manifest_filename, 'rU')
+	manifest = json.load(manifest_file)
+	manifest_file.close()
+	if manifest.get('version') != MANIFEST_VERSION:
+		print 'Manifest is from a different version - processing all XML files.'
+		return {}
+	return manifest['files']
+
+
+def write_manifest(output_directory, manifest_files):
+	""" Writes the manifest of the input files processed into the output directory. """
+	manifest_filename = os.path.join(output_directory, MANIFEST_FILENAME)
+	temp_manifest_filename = manifest_filename + '.' + str(os.getpid())
+	manifest_file = open(temp_manifest_filename, 'w')
+	json.dump({'version':MANIFEST_VERSION, 'files':manifest_files}, manifest_file, indent = 2, sort_keys = True)
+	manifest_file.close()
+	os.rename(temp_manifest_filename, manifest_filename)
+	print 'Manifest written to:', os.path.abspath(manifest_filename)
+
+
+def check_input_file(output_directory, filename, previous_entry):
+	"""
+		Returns the manifest entry of the input file and whether it is unchanged since the previous run.
+		Files with the same size and mtime as in the manifest are taken to be unchanged without hashing them,
+		and files whose output is missing are always processed again.
+	"""
+	stat = os.stat(filename)
+	entry = {'size':stat.st_size, 'mtime':stat.st_mtime}
+	if previous_entry == None or not os.path.exists(os.path.join(output_directory, previous_entry['output'])):
+		entry['hash'] = curation_io.get_file_hash(filename)
+		return entry, False
+
+	entry['output'] = previous_entry['output']
+	if entry['size'] == previous_entry['size'] and entry['mtime'] == previous_entry['mtime']:
+		entry['hash'] = previous_entry['hash']
+		return entry, True
+	entry['hash'] = curation_io.get_file_hash(filename)
+	return entry, entry['hash'] == previous_entry['hash']
+
+
+def process_changed_xml_files(output_directory, filenames, jobs = 1, force = False):
+	"""
+		Processes the XML files that are new or changed since the previous run into the output directory
+		and returns the (filename, status, message) result of each file, sorted by filename.
+		Unchanged files are 'skipped'. The manifest is updated with the files processed in this run.
+	"""
+	manifest_files = {}
+	if not force:
+		manifest_files = load_manifest(output_directory)
+
+	results = []
+	changed_filenames = []
+	changed_entries = {}
+	for filename in filenames:
+		key = os.path.basename(filename)
+		entry,unchanged = check_input_file(output_directory, filename, manifest_files.get(key))
+		if unchanged:
+			manifest_files[key] = entry
+			results.append((filename, 'skipped', 'unchanged since previous run'))
+		else:
+			changed_filenames.append(filename)
+			changed_entries[key] = entry
+	print 'Processing', len(changed_filenames), 'new or changed XML files, skipping', len(results), 'unchanged XML files.'
+
+	tasks = [(filename, output_directory) for filename in changed_filenames]
+	for filename,status,message in curation_io.run_file_tasks(process_xml_file, tasks, jobs, set_xml_backend, (XML_BACKEND,)):
+		key = os.path.basename(filename)
+		if status == 'processed':
+			manifest_files[key] = dict(changed_entries[key], output = os.path.basename(message))
+		else:
+			# failed files are processed again on the next run
+			manifest_files.pop(key, None)
+		results.append((filename, status, message))
+	write_manifest(output_directory, manifest_files)
+
+	results.sort()
+	return results
+
+
+def print_processing_results(results):
+	""" Prints the result of processing each XML file and returns the files that failed. """
+	failed = curation_io.print_file_results(results, 'Processing', 'XML files')
+	if not failed:
+		print 'Processed', len([status for filename,status,message in results if status == 'processed']), 'of', len(results), 'XML files.'
+	return failed
 
 
 def interface(args=None):
@@ -107,25 +414,53 @@ def interface(args=None):
 	parser.add_argument('-d', '--data_directory', type=str, required=False, help='Path to XML data directory')
 	parser.add_argument('-f', '--filename', type=str, required=False, help='Path to XML file')
 	parser.add_argument('-o', '--output_directory', type=str, required=True, help='Path to output directory for stripped XML files')
+	parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of XML files to process in parallel in data directory mode')
+	parser.add_argument('--force', action='store_true', help='Process all XML files, including those unchanged since the previous run')
+	parser.add_argument('--xml-backend', type=str, default='auto', choices=['auto'] + XML_BACKENDS, help='XML parser to use, auto picks the fastest installed one (cElementTree, then lxml, then ElementTree)')
+	parser.add_argument('--metrics-json', type=str, required=False, help='Path to write per-stage timing and counters as JSON')
 	return parser.parse_args(args)
 
 
 def main():
 	parsed_args = interface()
+	curation_metrics.enable_metrics('fmi_xml_processor', parsed_args.metrics_json)
 
 	data_directory = parsed_args.data_directory
 	output_directory = parsed_args.output_directory
 	filename = parsed_args.filename
+	jobs = parsed_args.jobs
+
+	if jobs < 1:
+		print 'ERROR: Invalid number of jobs:', jobs
+		sys.exit(2)
+
+	try:
+		set_xml_backend(parsed_args.xml_backend)
+	except ValueError as e:
+		print 'ERROR:', e
+		sys.exit(2)
+
+	if not os.path.exists(output_directory):
+		print 'Creating output directory:', output_directory
+		os.makedirs(output_directory)
 
-	files = []
 	if filename != None and os.path.exists(filename):
-		new_filename = cleanup_xml_file(output_directory, filename)
-		fmi_xml_processor(new_filename, output_directory)
+		filenames = [filename]
 	elif data_directory != None and os.path.exists(data_directory):
-		for fname in os.path.listdir(data_directory):
-			filename = os.path.join(data_directory, fname)
-			new_filename = cleanup_xml_file(output_directory, filename)
-			fmi_xml_processor(new_filename, output_directory)
+		filenames = get_xml_filenames(data_directory)
+	else:
+		print 'No such file or directory:', filename or data_directory
+		sys.exit(2)
+
+	# every output file is named after its input, so inputs with the same name would overwrite each other
+	output_basenames = [os.path.basename(curation_io.get_uncompressed_filename(fname)) for fname in filenames]
+	duplicates = sorted(set([basename for basename in output_basenames if output_basenames.count(basename) > 1]))
+	if duplicates:
+		print 'ERROR: More than one XML file would be written to the same output file:', ', '.join(duplicates)
+		sys.exit(2)
+
+	if print_processing_results(process_changed_xml_files(output_directory, filenames, jobs, parsed_args.force)):
+		sys.exit(2)
 
 if __name__ == '__main__':
 	main()
\ No newline at end of file
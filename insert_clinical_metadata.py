@@ -3,6 +3,9 @@ import sys
 import csv
 import optparse
 
+import curation_metrics
+import curation_io
+
 # some file descriptors
 ERROR_FILE = sys.stderr
 OUTPUT_FILE = sys.stdout
@@ -28,18 +31,22 @@ def process_datum(datum):
 		return dfixed
 
 def get_header(filename):
-	""" Returns the file header. """
-	filedata = [x for x in open(filename).read().split('\n') if not x.startswith('#')]
-	header = map(str.strip, filedata[0].split('\t'))
+	""" Returns the file header, i.e. the first line that is not commented. """
+	header_file = curation_io.open_input_file(filename)
+	line = header_file.readline()
+	while line.startswith('#'):
+		line = header_file.readline()
+	header_file.close()
+	header = map(str.strip, line.split('\t'))
 	return header
 
 
-def load_clinical_attribute_metadata():
+def load_clinical_attribute_metadata(metadata_filename = CLINICAL_ATTRIBUTE_METADATA_FILENAME):
 	""" Loads clinical attribute metadata. """
-	metadata_header = get_header(CLINICAL_ATTRIBUTE_METADATA_FILENAME)
+	metadata_header = get_header(metadata_filename)
 	
 	# read file and load clinical attribute metadata
-	metadata_file = open(CLINICAL_ATTRIBUTE_METADATA_FILENAME, 'rU')
+	metadata_file = open(metadata_filename, 'rU')
 	metadata_reader = csv.DictReader(metadata_file, dialect='excel-tab')
 	for line in metadata_reader:
 		column = line['NORMALIZED_COLUMN_HEADER']
@@ -90,7 +97,7 @@ def get_clinical_header_metadata(header, clinical_filename):
 	attribute_types = []
 	priorities = []
     
-	is_mixed_attributes = ('data_clinical.txt' == os.path.basename(clinical_filename))
+	is_mixed_attributes = ('data_clinical.txt' == os.path.basename(curation_io.get_uncompressed_filename(clinical_filename)))
 	for column in header:
 		if not column in CLINICAL_ATTRIBUTE_METADATA.keys():
 			print 'Clinical attribute not known:', column
@@ -119,52 +126,61 @@ def get_clinical_header_metadata(header, clinical_filename):
 	return metadata	
 
 
-def write_clinical_metadata(clinical_header, clinical_filename):
+def write_clinical_metadata(clinical_header, clinical_filename, compress = False):
 	""" Writes the clinical datafile with the metadata filtered by attribute type. """
 
 	# get the clinical metadata
 	clinical_metadata = get_clinical_header_metadata(clinical_header, clinical_filename)
 
 	# read the clinical data file and filter data by given header
-	clinical_file = open(clinical_filename, 'rU')
+	clinical_file = curation_io.open_input_file(clinical_filename)
 	clinical_reader = csv.DictReader(clinical_file, dialect='excel-tab')
 	filtered_clinical_data = ['\t'.join(clinical_header)]
 	for line in clinical_reader:
 		line_data = map(lambda x: process_datum(line.get(x, 'NA')), clinical_header)
 		filtered_clinical_data.append('\t'.join(line_data))
 	clinical_file.close()
+	curation_metrics.add_count('rows', len(filtered_clinical_data) - 1)
+	curation_metrics.add_file_size('input_bytes', clinical_filename)
 
 	# resolve the output filename 
 	output_directory = os.path.dirname(clinical_filename)
-	output_filename = os.path.join(output_directory, os.path.basename(clinical_filename) + '.metadata')
+	output_filename = curation_io.get_output_filename(os.path.join(output_directory, os.path.basename(curation_io.get_uncompressed_filename(clinical_filename)) + '.metadata'), compress, clinical_filename)
 
 	# combine metadata and filtered clinical data for output
 	output_data = clinical_metadata[:]
 	output_data.extend(filtered_clinical_data)
 
 	# create output file and write output data
-	output_file = open(output_filename, 'w')
+	output_file = curation_io.open_output_file(output_filename)
 	output_file.write('\n'.join(output_data))
 	output_file.close()
+	curation_metrics.add_file_size('output_bytes', output_filename)
 
 	print 'Clinical file with metadata written to:', output_filename
 
 
-def insert_clinical_metadata_main(directory):
+def insert_clinical_metadata_main(directory, compress = False):
 	""" Writes clinical data to separate clinical patient and clinical sample files. """
 	clinical_files = find_clinical_files(directory)
 
 	for clinical_filename in clinical_files:
 		# get the patient and sample clinical file headers
-		clinical_header = get_clinical_header(clinical_filename)
-		write_clinical_metadata(clinical_header, clinical_filename)
+		with curation_metrics.stage('header_read'):
+			clinical_header = get_clinical_header(clinical_filename)
+		with curation_metrics.stage('write_metadata'):
+			write_clinical_metadata(clinical_header, clinical_filename, compress)
 
 
 def find_clinical_files(directory):
-
+	"""
+		Returns the clinical data files in the directory, which may be compressed.
+		Files next to them that are not study data files (i.e., case id indexes) are skipped.
+	"""
 	clinical_files = []
 	for filename in os.listdir(directory):
-		if 'clinical' in filename and not 'meta' in filename: 
+		data_filename = curation_io.get_uncompressed_filename(filename)
+		if 'clinical' in data_filename and not 'meta' in data_filename and data_filename.endswith('.txt'):
 			clinical_files.append(os.path.join(directory, filename))
 
 	return clinical_files
@@ -172,16 +188,22 @@ def find_clinical_files(directory):
 
 
 def usage():
-	print >> OUTPUT_FILE, 'insert_clinical_metadata.py --directory cancer/study/path'
+	print >> OUTPUT_FILE, 'insert_clinical_metadata.py --directory cancer/study/path [--metadata-file path/to/clinical_attributes_metadata.txt] [--compress-output] [--metrics-json path/to/metrics.json]'
 	sys.exit(2)
 
 def main():
 	# get command line arguments
 	parser = optparse.OptionParser()
 	parser.add_option('-d', '--directory', action = 'store', dest = 'directory')
+	parser.add_option('-m', '--metadata-file', action = 'store', dest = 'metadatafile', default = CLINICAL_ATTRIBUTE_METADATA_FILENAME)
+	parser.add_option('-z', '--compress-output', action = 'store_true', dest = 'compressoutput', default = False)
+	parser.add_option('--metrics-json', action = 'store', dest = 'metricsjson')
 
 	(options, args) = parser.parse_args()
+	curation_metrics.enable_metrics('insert_clinical_metadata', options.metricsjson)
 	directory = options.directory
+	metadata_filename = options.metadatafile
+	compress_output = options.compressoutput
 
 	# exit if clinical file does not exist
 	if not os.path.exists(directory):
@@ -189,8 +211,12 @@ def main():
 		sys.exit(2)
 
 	# load clinical attribute metadata
-	load_clinical_attribute_metadata()
-	insert_clinical_metadata_main(directory)
+	if not os.path.exists(metadata_filename):
+		print 'No such file:', metadata_filename
+		sys.exit(2)
+	with curation_metrics.stage('load_metadata'):
+		load_clinical_attribute_metadata(metadata_filename)
+	insert_clinical_metadata_main(directory, compress_output)
 
 
 	
@@ -3,6 +3,9 @@ import sys
 import csv
 import optparse
 
+import curation_metrics
+import curation_io
+
 # some file descriptors
 ERROR_FILE = sys.stderr
 OUTPUT_FILE = sys.stdout
@@ -13,6 +16,8 @@ CLINICAL_FILE_PATTERN = 'data_clinical.txt'
 CLINICAL_PATIENT_FILE_PATTERN = 'data_clinical_patient.txt'
 CLINICAL_SAMPLE_FILE_PATTERN = 'data_clinical_sample.txt'
 
+OUTPUT_BUFFER_SIZE = 1024 * 1024
+
 CASE_ID_MAP = {MUTATION_FILE_PATTERN:'Tumor_Sample_Barcode',
 	CLINICAL_FILE_PATTERN:'SAMPLE_ID',
 	CLINICAL_PATIENT_FILE_PATTERN:'SAMPLE_ID',
@@ -20,9 +25,13 @@ CASE_ID_MAP = {MUTATION_FILE_PATTERN:'Tumor_Sample_Barcode',
 }
 
 def get_header(filename):
-	""" Returns the file header. """	
-	filedata = [x for x in open(filename).read().split('\n') if not x.startswith('#')]
-	header = map(str.strip, filedata[0].split('\t'))
+	""" Returns the file header, i.e. the first line that is not commented. """
+	header_file = curation_io.open_input_file(filename)
+	line = header_file.readline()
+	while line.startswith('#'):
+		line = header_file.readline()
+	header_file.close()
+	header = map(str.strip, line.split('\t'))
 	return header
 
 def get_case_ids(filename, column):
@@ -30,7 +39,7 @@ def get_case_ids(filename, column):
 	cases = []
 
 	# get the case ids from the designated column in the file
-	data_file = open(filename, 'rU')
+	data_file = curation_io.open_input_file(filename)
 	file_reader = csv.DictReader(data_file, dialect='excel-tab')
 	for line in file_reader:
 		case_id = line.get(column, 'NA').strip()
@@ -40,29 +49,44 @@ def get_case_ids(filename, column):
 	return list(set(cases))
 
 
-def insert_sequenced_samples_main(source_file, maf_file, output_directory):
+def insert_sequenced_samples_main(source_file, maf_file, output_directory, compress = False):
 	""" Creates a new MAF with the sequenced samples tag. """
 
 	# get the case id column from the source file and create list of case ids 
-	id_column = CASE_ID_MAP.get(os.path.basename(source_file), 'SAMPLE_ID')
-	case_id_list = get_case_ids(source_file, id_column)
-
-	# get everything from the file except any commented lines	
-	filedata = [x for x in open(maf_file).read().split('\n') if not x.startswith('#')]
-	sequenced_samples_tag = '#sequenced_samples: ' + ' '.join(case_id_list)
-
-	# format the data for the output file
-	output_data = '\n'.join([sequenced_samples_tag, '\n'.join(filedata)])
-
-	output_filename = os.path.join(output_directory, 'data_mutations_extended_seqsamples.txt')
-	output_file = open(output_filename, 'w')
-	output_file.write(output_data)
-	output_file.close()
+	id_column = CASE_ID_MAP.get(os.path.basename(curation_io.get_uncompressed_filename(source_file)), 'SAMPLE_ID')
+	with curation_metrics.stage('read_case_ids'):
+		case_id_list = get_case_ids(source_file, id_column)
+	curation_metrics.add_file_size('input_bytes', source_file)
+
+	with curation_metrics.stage('write_maf'):
+		sequenced_samples_tag = '#sequenced_samples: ' + ' '.join(case_id_list)
+		output_filename = curation_io.get_output_filename(os.path.join(output_directory, 'data_mutations_extended_seqsamples.txt'), compress, maf_file)
+		output_file = curation_io.open_output_file(output_filename, OUTPUT_BUFFER_SIZE)
+		output_file.write(sequenced_samples_tag)
+
+		# copy everything from the MAF except any commented lines as it is read
+		num_lines = 0
+		ends_with_newline = True
+		maf = curation_io.open_input_file(maf_file)
+		for line in maf:
+			ends_with_newline = line.endswith('\n')
+			if ends_with_newline:
+				line = line[:-1]
+			if not line.startswith('#'):
+				output_file.write('\n' + line)
+				num_lines += 1
+		if ends_with_newline:
+			output_file.write('\n')
+		maf.close()
+		output_file.close()
+	curation_metrics.add_count('rows', num_lines - 1)
+	curation_metrics.add_file_size('input_bytes', maf_file)
+	curation_metrics.add_file_size('output_bytes', output_filename)
 	print 'MAF with sequenced samples tag written to:', output_filename
 
 
 def usage():
-	print >> OUTPUT_FILE, 'insert_sequenced_samples.py --source-file path/to/source --maf-file [path/to/maf] --output-directory [/path/to/output]'
+	print >> OUTPUT_FILE, 'insert_sequenced_samples.py --source-file path/to/source --maf-file [path/to/maf] --output-directory [/path/to/output] [--compress-output] [--metrics-json path/to/metrics.json]'
 
 
 def main():
@@ -71,12 +95,16 @@ def main():
 	parser.add_option('-s', '--source-file', action = 'store', dest = 'sourcefile')
 	parser.add_option('-d', '--output-directory', action = 'store', dest = 'outputdir')
 	parser.add_option('-m', '--maf-file', action = 'store', dest = 'maffile')
+	parser.add_option('-z', '--compress-output', action = 'store_true', dest = 'compressoutput', default = False)
+	parser.add_option('--metrics-json', action = 'store', dest = 'metricsjson')
 
 	(options, args) = parser.parse_args()
+	curation_metrics.enable_metrics('insert_sequenced_samples', options.metricsjson)
 	source_file = options.sourcefile
 	# output_directory = options.outputdir
 	output_directory = os.path.dirname(source_file)
 	maf_filename = options.maffile
+	compress_output = options.compressoutput
 
 	# set output directory to source file directory if none provided
 	if not output_directory:
@@ -93,7 +121,7 @@ def main():
 		print 'No such directory:', output_directory
 		sys.exit(2)
 
-	insert_sequenced_samples_main(source_file, maf_filename, output_directory)
+	insert_sequenced_samples_main(source_file, maf_filename, output_directory, compress_output)
 
 
 if __name__ == '__main__':
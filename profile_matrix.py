@@ -0,0 +1,338 @@
+import os
+import sys
+import json
+import optparse
+
+import curation_io
+import curation_metrics
+
+# numpy is optional - without it profile files are only read as text
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+# some file descriptors
+ERROR_FILE = sys.stderr
+OUTPUT_FILE = sys.stdout
+
+# binary matrix written next to each profile file, with its gene index, sample index and metadata
+MATRIX_EXTENSION = '.matrix'
+GENES_EXTENSION = '.genes'
+SAMPLES_EXTENSION = '.samples'
+METADATA_EXTENSION = '.json'
+MATRIX_VERSION = 1
+MATRIX_DTYPE = 'float64'
+
+# number of rows converted at a time
+CONVERSION_CHUNK_SIZE = 1000
+
+NON_CASE_IDS = ['Hugo_Symbol', 'Entrez_Gene_Id']
+PROFILE_DATATYPE_FILENAMES = [
+	'data_CNA.txt', 'data_expression_median.txt', 'data_expression_miRNA.txt',
+	'data_methylation_hm27.txt', 'data_RNA_Seq_expression_median.txt'
+]
+
+
+class ProfileMatrix(object):
+	"""
+		Profile data stored as a memory-mapped genes x samples matrix.
+		The matrix is stored column-major, so the values of each sample are contiguous on disk
+		and reading a subset of sample columns only touches the pages of those samples.
+	"""
+	def __init__(self, filename, metadata, gene_header, genes, samples):
+		self.filename = filename
+		self.gene_header = gene_header
+		self.genes = genes
+		self.samples = samples
+		self.missing_value = metadata['missing_value']
+		self.decimal_places = metadata['decimal_places']
+		self.lossless = metadata['lossless']
+		self.values = numpy.memmap(filename + MATRIX_EXTENSION, dtype = metadata['dtype'], mode = 'r', shape = tuple(metadata['shape']), order = 'F')
+
+		self.sample_index = {}
+		for i,sample_id in enumerate(samples):
+			self.sample_index.setdefault(sample_id, i)
+
+		# number of non-empty gene labels (i.e., Hugo_Symbol, Entrez_Gene_Id) in each row
+		self.gene_data_counts = numpy.array([len(gene) - gene.count('') for gene in genes], dtype = int)
+
+	def get_sample_indices(self, sample_ids):
+		""" Returns the column of each sample, or -1 for samples not in the matrix. """
+		return [self.sample_index.get(sample_id, -1) for sample_id in sample_ids]
+
+	def get_sample_data_counts(self, sample_indices):
+		""" Returns the number of samples with a non-empty value in each row, counted over the given sample columns. """
+		sample_indices = [i for i in sample_indices if i >= 0]
+		if not sample_indices:
+			return numpy.zeros(len(self.genes), dtype = int)
+		# missing values are only empty if they were empty strings in the text profile
+		if self.missing_value != '':
+			return numpy.repeat(len(sample_indices), len(self.genes))
+		return (~numpy.isnan(self.values[:, sample_indices])).sum(axis = 1)
+
+	def has_data_in_every_row(self, sample_indices, non_case_id_count):
+		"""
+			Returns whether every row has more non-empty values than the number of non case id columns,
+			counting the gene labels and the given sample columns, as checked for filtered text profiles.
+		"""
+		return bool(((self.gene_data_counts + self.get_sample_data_counts(sample_indices)) > non_case_id_count).all())
+
+	def get_rows(self, sample_indices, start = 0, end = None):
+		""" Yields the gene labels and the formatted values of the given sample columns for each row, as lists. """
+		if end == None:
+			end = len(self.genes)
+		present_indices = [i for i in sample_indices if i >= 0]
+		for chunk_start in range(start, end, CONVERSION_CHUNK_SIZE):
+			chunk_end = min(chunk_start + CONVERSION_CHUNK_SIZE, end)
+			chunk = self.values[chunk_start:chunk_end, present_indices].tolist() if present_indices else [[] for i in range(chunk_end - chunk_start)]
+			for gene,values in zip(self.genes[chunk_start:chunk_end], chunk):
+				values = iter(map(self.format_value, values))
+				yield gene + [values.next() if i >= 0 else '' for i in sample_indices]
+
+	def format_value(self, value):
+		return format_value(value, self.missing_value, self.decimal_places)
+
+
+def format_value(value, missing_value, decimal_places = None):
+	"""
+		Formats the matrix value as it is written in a text profile, i.e. 2.0 as '2',
+		or with a fixed number of decimal places if the profile was written that way.
+	"""
+	if value != value:
+		return missing_value
+	if decimal_places != None:
+		return '%.*f' % (decimal_places, value)
+	value = repr(value)
+	if value.endswith('.0'):
+		return value[:-2]
+	return value
+
+
+def get_matrix_filenames(filename):
+	""" Returns the matrix, gene index, sample index and metadata filenames of the profile file. """
+	matrix_filename = filename + MATRIX_EXTENSION
+	return matrix_filename, matrix_filename + GENES_EXTENSION, matrix_filename + SAMPLES_EXTENSION, matrix_filename + METADATA_EXTENSION
+
+
+def convert_profile_file(filename):
+	"""
+		Converts the profile file to a memory-mapped binary matrix with gene and sample index files.
+		Values that can't be stored exactly (i.e., text values or mixed missing values) are stored as
+		missing, in which case the matrix is marked as not lossless and isn't used in place of the text profile.
+	"""
+	matrix_filename,genes_filename,samples_filename,metadata_filename = get_matrix_filenames(filename)
+
+	# first pass: get the header and count the rows
+	header = None
+	num_rows = 0
+	data_file = curation_io.open_input_file(filename)
+	for line in data_file:
+		if line.startswith('#'):
+			continue
+		if header == None:
+			header = map(str.strip, line.split('\t'))
+		elif line.rstrip('\r\n'):
+			num_rows += 1
+	data_file.close()
+	if header == None:
+		print 'ERROR: No header found in file:', filename
+		return None
+
+	gene_indices = [i for i,hdr in enumerate(header) if hdr in NON_CASE_IDS]
+	sample_indices = [i for i,hdr in enumerate(header) if hdr not in NON_CASE_IDS]
+	gene_header = [header[i] for i in gene_indices]
+	samples = [header[i] for i in sample_indices]
+	if num_rows == 0 or not samples:
+		print 'ERROR: No profile data to convert in file:', filename
+		return None
+
+	# second pass: write the values to the matrix in chunks of rows
+	values = numpy.memmap(matrix_filename, dtype = MATRIX_DTYPE, mode = 'w+', shape = (num_rows, len(samples)), order = 'F')
+	missing_values = set()
+	lossy_values = 0
+
+	# profiles are often written with a fixed number of decimal places (i.e., -0.3440), taken from the first value
+	decimal_places = None
+	lossy_decimal_values = 0
+	genes_file = open(genes_filename, 'w')
+	genes_file.write('\t'.join(gene_header))
+
+	chunk = []
+	row_index = 0
+	header_found = False
+	data_file = curation_io.open_input_file(filename)
+	for line in data_file:
+		if line.startswith('#'):
+			continue
+		if not header_found:
+			header_found = True
+			continue
+		if not line.rstrip('\r\n'):
+			continue
+
+		fields = line.rstrip('\r\n').split('\t')
+		fields.extend([''] * (len(header) - len(fields)))
+		genes_file.write('\n' + '\t'.join([fields[i].strip() for i in gene_indices]))
+
+		row = []
+		for i in sample_indices:
+			value = fields[i].strip()
+			try:
+				row.append(float(value))
+				if format_value(row[-1], None) != value:
+					lossy_values += 1
+				if decimal_places == None:
+					decimal_places = len(value.split('.', 1)[1]) if '.' in value else 0
+				if format_value(row[-1], None, decimal_places) != value:
+					lossy_decimal_values += 1
+			except ValueError:
+				row.append(float('nan'))
+				missing_values.add(value)
+		chunk.append(row)
+
+		if len(chunk) == CONVERSION_CHUNK_SIZE:
+			values[row_index:row_index + len(chunk), :] = chunk
+			row_index += len(chunk)
+			chunk = []
+	data_file.close()
+	genes_file.close()
+	if chunk:
+		values[row_index:row_index + len(chunk), :] = chunk
+	values.flush()
+	del values
+
+	samples_file = open(samples_filename, 'w')
+	samples_file.write('\n'.join(samples))
+	samples_file.close()
+
+	# the text values that were stored as missing - only a single missing value can be written back as it was
+	if lossy_values == 0:
+		decimal_places = None
+	lossless = ((lossy_values == 0 or lossy_decimal_values == 0) and len(missing_values) <= 1)
+	size,mtime = curation_io.get_file_signature(filename)
+	metadata = {
+		'version':MATRIX_VERSION,
+		'dtype':MATRIX_DTYPE,
+		'shape':[num_rows, len(samples)],
+		'source_size':size,
+		'source_mtime':mtime,
+		'missing_value':list(missing_values)[0] if len(missing_values) == 1 else 'NA',
+		'decimal_places':decimal_places,
+		'lossless':lossless
+	}
+	metadata_file = open(metadata_filename, 'w')
+	json.dump(metadata, metadata_file, indent = 2, sort_keys = True)
+	metadata_file.close()
+
+	if not lossless:
+		print 'WARNING: Profile file has values that are not stored exactly - matrix will not be used for filtering:', filename
+	return matrix_filename
+
+
+def load_profile_matrix(filename):
+	"""
+		Returns the memory-mapped matrix of the profile file.
+		Returns None if numpy is not installed, or if there is no matrix or it is out of date.
+	"""
+	matrix_filename,genes_filename,samples_filename,metadata_filename = get_matrix_filenames(filename)
+	if numpy == None or not os.path.exists(metadata_filename):
+		return None
+
+	metadata_file = open(metadata_filename, 'rU')
+	metadata = json.load(metadata_file)
+	metadata_file.close()
+	if metadata.get('version') != MATRIX_VERSION:
+		print 'WARNING: Ignoring invalid profile matrix:', matrix_filename
+		return None
+	if (metadata['source_size'], metadata['source_mtime']) != curation_io.get_file_signature(filename):
+		print 'WARNING: Ignoring out of date profile matrix:', matrix_filename
+		return None
+
+	genes_file = open(genes_filename, 'rU')
+	gene_header = genes_file.readline().rstrip('\n').split('\t')
+	if gene_header == ['']:
+		gene_header = []
+	genes = [line.rstrip('\n').split('\t')[:len(gene_header)] for line in genes_file]
+	genes_file.close()
+
+	samples_file = open(samples_filename, 'rU')
+	samples = samples_file.read().split('\n') if metadata['shape'][1] > 0 else []
+	samples_file.close()
+	return ProfileMatrix(filename, metadata, gene_header, genes, samples)
+
+
+def write_profile_tsv(profile_matrix, output_filename, sample_ids = None):
+	""" Writes the profile matrix back to a tab-delimited profile file, for all samples or the given samples. """
+	if sample_ids == None:
+		sample_ids = profile_matrix.samples
+	sample_indices = profile_matrix.get_sample_indices(sample_ids)
+
+	output_file = curation_io.open_output_file(output_filename)
+	output_file.write('\t'.join(profile_matrix.gene_header + list(sample_ids)))
+	for row in profile_matrix.get_rows(sample_indices):
+		output_file.write('\n' + '\t'.join(row))
+	output_file.close()
+	print 'Profile data written to:', output_filename
+
+
+def convert_study_directory(input_directory):
+	""" Converts every profile file in the study directory to a binary matrix. """
+	num_converted = 0
+	for filename in sorted(os.listdir(input_directory)):
+		if curation_io.get_uncompressed_filename(filename) not in PROFILE_DATATYPE_FILENAMES:
+			continue
+
+		print 'Converting profile file:', filename
+		with curation_metrics.stage('convert_profile_file'):
+			matrix_filename = convert_profile_file(os.path.join(input_directory, filename))
+		curation_metrics.add_file_size('input_bytes', os.path.join(input_directory, filename))
+		if matrix_filename != None:
+			print 'Profile matrix written to:', matrix_filename
+			num_converted += 1
+			curation_metrics.add_count('converted_files')
+	print 'Converted', num_converted, 'profile files in:', input_directory
+
+
+def usage():
+	print >> OUTPUT_FILE, 'profile_matrix.py (--input-directory path/to/study/directory | --profile-file path/to/profile --output-file path/to/output/tsv) [--metrics-json path/to/metrics.json]'
+
+
+def main():
+	# get command line arguments
+	parser = optparse.OptionParser()
+	parser.add_option('-i', '--input-directory', action = 'store', dest = 'inputdir')
+	parser.add_option('-p', '--profile-file', action = 'store', dest = 'profilefile')
+	parser.add_option('-o', '--output-file', action = 'store', dest = 'outputfile')
+	parser.add_option('--metrics-json', action = 'store', dest = 'metricsjson')
+
+	(options, args) = parser.parse_args()
+	curation_metrics.enable_metrics('profile_matrix', options.metricsjson)
+	input_directory = options.inputdir
+	profile_filename = options.profilefile
+	output_filename = options.outputfile
+
+	if numpy == None:
+		print 'ERROR: numpy is required to convert profile files to binary matrices.'
+		sys.exit(2)
+
+	if input_directory != None:
+		if not os.path.isdir(input_directory):
+			print 'No such directory:', input_directory
+			sys.exit(2)
+		convert_study_directory(input_directory)
+	elif profile_filename != None and output_filename != None:
+		with curation_metrics.stage('load_profile_matrix'):
+			profile_matrix = load_profile_matrix(profile_filename)
+		if profile_matrix == None:
+			print 'ERROR: No up to date profile matrix found for:', profile_filename
+			sys.exit(2)
+		with curation_metrics.stage('write_profile_tsv'):
+			write_profile_tsv(profile_matrix, output_filename)
+	else:
+		usage()
+		sys.exit(2)
+
+
+if __name__ == '__main__':
+	main()
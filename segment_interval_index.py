@@ -0,0 +1,248 @@
+import os
+import sys
+import bisect
+import optparse
+
+import curation_io
+import curation_metrics
+
+# some file descriptors
+ERROR_FILE = sys.stderr
+OUTPUT_FILE = sys.stdout
+
+# sidecar index written next to each segment file
+INDEX_EXTENSION = '.sidx'
+INDEX_VERSION = '1'
+
+# positions of the chromosome, start and end columns in a segment file (ID, chrom, loc.start, loc.end, num.mark, seg.mean)
+SEG_CHROM_INDEX = 1
+SEG_START_INDEX = 2
+SEG_END_INDEX = 3
+
+# end position of a region that covers a whole chromosome
+CHROMOSOME_END = sys.maxint
+
+
+def normalize_chromosome(chrom):
+	""" Returns the chromosome name without a 'chr' prefix, i.e. so that 'chr7' matches '7'. """
+	chrom = chrom.strip()
+	if chrom.lower().startswith('chr'):
+		chrom = chrom[3:]
+	return chrom.upper()
+
+
+def get_segment_position(fields):
+	""" Returns the (chromosome, start, end) of the split segment row, or None if the row has no valid position. """
+	try:
+		return normalize_chromosome(fields[SEG_CHROM_INDEX]), int(float(fields[SEG_START_INDEX])), int(float(fields[SEG_END_INDEX]))
+	except (IndexError, ValueError):
+		return None
+
+
+def parse_region(region):
+	""" Parses a region given as chrom, chrom:position or chrom:start-end into (chromosome, start, end). """
+	region = region.strip().replace(',', '')
+	if ':' not in region:
+		return normalize_chromosome(region), 0, CHROMOSOME_END
+	chrom,positions = region.split(':', 1)
+	if '-' in positions:
+		start,end = positions.split('-', 1)
+	else:
+		start,end = positions,positions
+	start,end = int(start),int(end)
+	if start > end:
+		raise ValueError('region start is after region end: ' + region)
+	return normalize_chromosome(chrom), start, end
+
+
+def load_regions(regions):
+	"""
+		Returns the list of (chromosome, start, end) regions from a comma-separated list of regions,
+		or from a file with one region per line. BED files are also accepted, in which case
+		their 0-based starts are converted to the 1-based positions used by segment files.
+	"""
+	if not os.path.isfile(regions):
+		return [parse_region(region) for region in regions.split(',') if region.strip()]
+
+	region_list = []
+	regions_file = open(regions, 'rU')
+	for line in regions_file:
+		if not line.strip() or line.startswith('#') or line.startswith('track') or line.startswith('browser'):
+			continue
+		line_data = line.strip().split('\t')
+		if len(line_data) >= 3:
+			region_list.append((normalize_chromosome(line_data[0]), int(line_data[1]) + 1, int(line_data[2])))
+		else:
+			region_list.append(parse_region(line_data[0]))
+	regions_file.close()
+	return region_list
+
+
+def segment_overlaps(position, regions):
+	""" Returns whether the segment (chromosome, start, end) overlaps any of the regions. """
+	if position == None:
+		return False
+	chrom,start,end = position
+	for region_chrom,region_start,region_end in regions:
+		if chrom == region_chrom and start <= region_end and end >= region_start:
+			return True
+	return False
+
+
+def build_segment_index(filename):
+	"""
+		Scans the segment file once and writes the position and byte range of every segment
+		to the sidecar index, sorted by chromosome and start position.
+	"""
+	segments = []
+	header_found = False
+
+	seg_file = open(filename, 'rb')
+	offset = 0
+	for line in seg_file:
+		line_start = offset
+		offset += len(line)
+
+		# skip commented lines, the header and blank lines
+		if line.startswith('#'):
+			continue
+		if not header_found:
+			header_found = True
+			continue
+		if not line.rstrip('\r\n'):
+			continue
+
+		position = get_segment_position(line.rstrip('\r\n').split('\t', SEG_END_INDEX + 1))
+		if position != None:
+			segments.append(position + (line_start, offset - line_start))
+	seg_file.close()
+	segments.sort()
+
+	size,mtime = curation_io.get_file_signature(filename)
+	index_filename = filename + INDEX_EXTENSION
+	temp_index_filename = index_filename + '.' + str(os.getpid())
+	index_file = open(temp_index_filename, 'w')
+	index_file.write('\t'.join(['#segment_index', INDEX_VERSION, size, mtime]))
+	for segment in segments:
+		index_file.write('\n' + '\t'.join(map(str, segment)))
+	index_file.close()
+	os.rename(temp_index_filename, index_filename)
+	return index_filename
+
+
+def load_segment_index(filename, regions):
+	"""
+		Returns the segments on the chromosomes of the regions from the sidecar index of the segment file,
+		as chromosome -> (segment starts, segments, longest segment length).
+		Returns None if there is no index or if it is out of date.
+	"""
+	index_filename = filename + INDEX_EXTENSION
+	if not os.path.exists(index_filename):
+		return None
+
+	index_file = open(index_filename, 'rU')
+	index_info = index_file.readline().rstrip('\n').split('\t')
+	if len(index_info) != 4 or index_info[0] != '#segment_index' or index_info[1] != INDEX_VERSION:
+		index_file.close()
+		print 'WARNING: Ignoring invalid segment index:', index_filename
+		return None
+	if tuple(index_info[2:4]) != curation_io.get_file_signature(filename):
+		index_file.close()
+		print 'WARNING: Ignoring out of date segment index:', index_filename
+		return None
+
+	# only the segments on the chromosomes of the regions are loaded
+	region_chroms = set([region[0] for region in regions])
+	chrom_segments = {}
+	for line in index_file:
+		chrom,segment = line.split('\t', 1)
+		if chrom in region_chroms:
+			chrom_segments.setdefault(chrom, []).append(tuple(map(int, segment.split('\t'))))
+	index_file.close()
+
+	segment_index = {}
+	for chrom,segments in chrom_segments.items():
+		segment_index[chrom] = ([segment[0] for segment in segments], segments, max([end - start for start,end,offset,length in segments]))
+	return segment_index
+
+
+def get_region_byte_ranges(segment_index, regions):
+	""" Returns the merged byte ranges of the segments overlapping the regions, in file order. """
+	segment_ranges = set()
+	for chrom,region_start,region_end in regions:
+		if chrom not in segment_index:
+			continue
+		starts,segments,max_length = segment_index[chrom]
+
+		# segments starting before the region start by more than the longest segment cannot overlap it
+		lo = bisect.bisect_left(starts, region_start - max_length)
+		hi = bisect.bisect_right(starts, region_end)
+		for start,end,offset,length in segments[lo:hi]:
+			if end >= region_start:
+				segment_ranges.add((offset, length))
+
+	byte_ranges = []
+	for offset,length in sorted(segment_ranges):
+		if byte_ranges and byte_ranges[-1][0] + byte_ranges[-1][1] == offset:
+			byte_ranges[-1][1] += length
+		else:
+			byte_ranges.append([offset, length])
+	return byte_ranges
+
+
+def read_region_rows(filename, segment_index, regions):
+	""" Yields the rows of the segment file that overlap the regions in file order, seeking directly to them. """
+	seg_file = open(filename, 'rb')
+	for offset,length in get_region_byte_ranges(segment_index, regions):
+		seg_file.seek(offset)
+		for line in seg_file.read(length).splitlines():
+			if line:
+				yield line
+	seg_file.close()
+
+
+def index_study_directory(input_directory):
+	""" Writes the segment index for every segment file in the study directory. """
+	num_indexed = 0
+	for filename in sorted(os.listdir(input_directory)):
+		filename_path = os.path.join(input_directory, filename)
+		if os.path.isdir(filename_path) or not filename.endswith('.seg'):
+			continue
+
+		print 'Indexing segment file:', filename
+		with curation_metrics.stage('build_segment_index'):
+			index_filename = build_segment_index(filename_path)
+		curation_metrics.add_file_size('input_bytes', filename_path)
+		curation_metrics.add_count('indexed_files')
+		print 'Segment index written to:', index_filename
+		num_indexed += 1
+	print 'Indexed', num_indexed, 'segment files in:', input_directory
+
+
+def usage():
+	print >> OUTPUT_FILE, 'segment_interval_index.py --input-directory path/to/study/directory [--metrics-json path/to/metrics.json]'
+
+
+def main():
+	# get command line arguments
+	parser = optparse.OptionParser()
+	parser.add_option('-i', '--input-directory', action = 'store', dest = 'inputdir')
+	parser.add_option('--metrics-json', action = 'store', dest = 'metricsjson')
+
+	(options, args) = parser.parse_args()
+	curation_metrics.enable_metrics('segment_interval_index', options.metricsjson)
+	input_directory = options.inputdir
+
+	if input_directory == None:
+		usage()
+		sys.exit(2)
+
+	if not os.path.isdir(input_directory):
+		print 'No such directory:', input_directory
+		sys.exit(2)
+
+	index_study_directory(input_directory)
+
+
+if __name__ == '__main__':
+	main()
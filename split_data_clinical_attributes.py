@@ -3,6 +3,9 @@ import sys
 import csv
 import optparse
 
+import curation_metrics
+import curation_io
+
 # some file descriptors
 ERROR_FILE = sys.stderr
 OUTPUT_FILE = sys.stdout
@@ -15,18 +18,22 @@ CLINICAL_PATIENT_FILENAME = 'data_clinical_patient.txt'
 CLINICAL_SAMPLE_FILENAME = 'data_clinical_sample.txt'
 
 def get_header(filename):
-	""" Returns the file header. """
-	filedata = [x for x in open(filename).read().split('\n') if not x.startswith('#')]
-	header = map(str.strip, filedata[0].split('\t'))
+	""" Returns the file header, i.e. the first line that is not commented. """
+	header_file = curation_io.open_input_file(filename)
+	line = header_file.readline()
+	while line.startswith('#'):
+		line = header_file.readline()
+	header_file.close()
+	header = map(str.strip, line.split('\t'))
 	return header
 
 
-def load_clinical_attribute_metadata():
+def load_clinical_attribute_metadata(metadata_filename = CLINICAL_ATTRIBUTE_METADATA_FILENAME):
 	""" Loads clinical attribute metadata. """
-	metadata_header = get_header(CLINICAL_ATTRIBUTE_METADATA_FILENAME)
+	metadata_header = get_header(metadata_filename)
 	
 	# read file and load clinical attribute metadata
-	metadata_file = open(CLINICAL_ATTRIBUTE_METADATA_FILENAME, 'rU')
+	metadata_file = open(metadata_filename, 'rU')
 	metadata_reader = csv.DictReader(metadata_file, dialect='excel-tab')
 	for line in metadata_reader:
 		column = line['NORMALIZED_COLUMN_HEADER']
@@ -95,26 +102,27 @@ def get_clinical_header_metadata(header):
 	return metadata	
 
 
-def write_clinical_datafile(clinical_header, is_patient_file, clinical_filename):
+def write_clinical_datafile(clinical_header, is_patient_file, clinical_filename, compress = False):
 	""" Writes the clinical datafile with the metadata filtered by attribute type. """
 
 	# get the clinical metadata
 	clinical_metadata = get_clinical_header_metadata(clinical_header)
 
 	# read the clinical data file and filter data by given header
-	clinical_file = open(clinical_filename, 'rU')
+	clinical_file = curation_io.open_input_file(clinical_filename)
 	clinical_reader = csv.DictReader(clinical_file, dialect='excel-tab')
 	filtered_clinical_data = ['\t'.join(clinical_header)]
 	for line in clinical_reader:
 		line_data = map(lambda x: line.get(x, 'NA'), clinical_header)
 		filtered_clinical_data.append('\t'.join(line_data))
+	curation_metrics.add_count('rows', len(filtered_clinical_data) - 1)
 
 	# resolve the output filename 
 	output_directory = os.path.dirname(os.path.abspath(clinical_filename))
 	if is_patient_file:
-		output_filename = os.path.join(output_directory, CLINICAL_PATIENT_FILENAME)
+		output_filename = curation_io.get_output_filename(os.path.join(output_directory, CLINICAL_PATIENT_FILENAME), compress, clinical_filename)
 	else: 
-		output_filename = os.path.join(output_directory, CLINICAL_SAMPLE_FILENAME)
+		output_filename = curation_io.get_output_filename(os.path.join(output_directory, CLINICAL_SAMPLE_FILENAME), compress, clinical_filename)
 	clinical_file.close()
 
 	# combine metadata and filtered clinical data for output
@@ -122,9 +130,10 @@ def write_clinical_datafile(clinical_header, is_patient_file, clinical_filename)
 	output_data.extend(filtered_clinical_data)
 
 	# create output file and write output data
-	output_file = open(output_filename, 'w')
+	output_file = curation_io.open_output_file(output_filename)
 	output_file.write('\n'.join(output_data))
 	output_file.close()
+	curation_metrics.add_file_size('output_bytes', output_filename)
 
 	if is_patient_file:
 		print 'Patient clinical data written to:', output_filename
@@ -132,19 +141,23 @@ def write_clinical_datafile(clinical_header, is_patient_file, clinical_filename)
 		print 'Sample clinical data written to:', output_filename
 
 
-def split_data_clinical_attributes_main(clinical_filename):
+def split_data_clinical_attributes_main(clinical_filename, compress = False):
 	""" Writes clinical data to separate clinical patient and clinical sample files. """
 
 	# get the patient and sample clinical file headers
-	patient_clinical_header = get_clinical_header(clinical_filename, True)
-	sample_clinical_header = get_clinical_header(clinical_filename, False)
+	with curation_metrics.stage('header_read'):
+		patient_clinical_header = get_clinical_header(clinical_filename, True)
+		sample_clinical_header = get_clinical_header(clinical_filename, False)
+	curation_metrics.add_file_size('input_bytes', clinical_filename)
 
-	write_clinical_datafile(patient_clinical_header, True, clinical_filename)
-	write_clinical_datafile(sample_clinical_header, False, clinical_filename)
+	with curation_metrics.stage('write_patient_file'):
+		write_clinical_datafile(patient_clinical_header, True, clinical_filename, compress)
+	with curation_metrics.stage('write_sample_file'):
+		write_clinical_datafile(sample_clinical_header, False, clinical_filename, compress)
 
 
 def usage():
-	print >> OUTPUT_FILE, 'split_data_clinical_attributes.py --clinical-file path/to/clinical/file'
+	print >> OUTPUT_FILE, 'split_data_clinical_attributes.py --clinical-file path/to/clinical/file [--metadata-file path/to/clinical_attributes_metadata.txt] [--compress-output] [--metrics-json path/to/metrics.json]'
 	sys.exit(2)
 
 
@@ -152,9 +165,15 @@ def main():
 	# get command line arguments
 	parser = optparse.OptionParser()
 	parser.add_option('-c', '--clinical-file', action = 'store', dest = 'clinfile')
+	parser.add_option('-m', '--metadata-file', action = 'store', dest = 'metadatafile', default = CLINICAL_ATTRIBUTE_METADATA_FILENAME)
+	parser.add_option('-z', '--compress-output', action = 'store_true', dest = 'compressoutput', default = False)
+	parser.add_option('--metrics-json', action = 'store', dest = 'metricsjson')
 
 	(options, args) = parser.parse_args()
+	curation_metrics.enable_metrics('split_data_clinical_attributes', options.metricsjson)
 	clinical_filename = options.clinfile
+	metadata_filename = options.metadatafile
+	compress_output = options.compressoutput
 
 	if not clinical_filename:
 		usage()
@@ -165,8 +184,12 @@ def main():
 		sys.exit(2)
 
 	# load clinical attribute metadata
-	load_clinical_attribute_metadata()
-	split_data_clinical_attributes_main(clinical_filename)
+	if not os.path.exists(metadata_filename):
+		print 'No such file:', metadata_filename
+		sys.exit(2)
+	with curation_metrics.stage('load_metadata'):
+		load_clinical_attribute_metadata(metadata_filename)
+	split_data_clinical_attributes_main(clinical_filename, compress_output)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,207 @@
+import re
+
+# predicate grammar:
+#	predicate  := and_expr ('or' and_expr)*
+#	and_expr   := not_expr ('and' not_expr)*
+#	not_expr   := 'not' not_expr | '(' predicate ')' | comparison
+#	comparison := ATTRIBUTE ('=' | '==' | '!=' | '<' | '<=' | '>' | '>=') value
+#	            | ATTRIBUTE ['not'] 'in' '(' value (',' value)* ')'
+TOKEN_PATTERN = re.compile(r'\s*(?:(==|!=|<=|>=|=|<|>|\(|\)|,)|"([^"]*)"|\'([^\']*)\'|([^\s(),=!<>"\']+))')
+KEYWORDS = ['and', 'or', 'not', 'in']
+COMPARISON_OPERATORS = ['=', '==', '!=', '<', '<=', '>', '>=']
+
+
+def tokenize(predicate):
+	""" Splits the predicate into (kind, token) pairs, where kind is 'op', 'value' or 'word'. """
+	tokens = []
+	position = 0
+	predicate = predicate.strip()
+	while position < len(predicate):
+		match = TOKEN_PATTERN.match(predicate, position)
+		if match == None or match.end() == position:
+			raise ValueError('unexpected character at position ' + str(position) + ': ' + predicate[position:])
+		operator,double_quoted,single_quoted,word = match.groups()
+		if operator != None:
+			tokens.append(('op', operator))
+		elif double_quoted != None:
+			tokens.append(('value', double_quoted))
+		elif single_quoted != None:
+			tokens.append(('value', single_quoted))
+		else:
+			tokens.append(('word', word))
+		position = match.end()
+	return tokens
+
+
+class PredicateParser(object):
+	""" Recursive descent parser that compiles a predicate into a tree of ('and'|'or'|'not'|'compare'|'in', ...) nodes. """
+	def __init__(self, predicate):
+		self.tokens = tokenize(predicate)
+		self.position = 0
+
+	def peek(self):
+		if self.position < len(self.tokens):
+			return self.tokens[self.position]
+		return (None, None)
+
+	def next(self):
+		token = self.peek()
+		if token[0] == None:
+			raise ValueError('unexpected end of predicate')
+		self.position += 1
+		return token
+
+	def is_keyword(self, keyword):
+		kind,token = self.peek()
+		return kind == 'word' and token.lower() == keyword
+
+	def expect(self, operator):
+		kind,token = self.next()
+		if kind != 'op' or token != operator:
+			raise ValueError('expected "' + operator + '" but found "' + str(token) + '"')
+
+	def parse(self):
+		node = self.parse_or()
+		if self.peek()[0] != None:
+			raise ValueError('unexpected "' + self.peek()[1] + '"')
+		return node
+
+	def parse_or(self):
+		nodes = [self.parse_and()]
+		while self.is_keyword('or'):
+			self.next()
+			nodes.append(self.parse_and())
+		if len(nodes) == 1:
+			return nodes[0]
+		return ('or', nodes)
+
+	def parse_and(self):
+		nodes = [self.parse_not()]
+		while self.is_keyword('and'):
+			self.next()
+			nodes.append(self.parse_not())
+		if len(nodes) == 1:
+			return nodes[0]
+		return ('and', nodes)
+
+	def parse_not(self):
+		if self.is_keyword('not'):
+			self.next()
+			return ('not', self.parse_not())
+		if self.peek() == ('op', '('):
+			self.next()
+			node = self.parse_or()
+			self.expect(')')
+			return node
+		return self.parse_comparison()
+
+	def parse_comparison(self):
+		kind,attribute = self.next()
+		if kind != 'word' or attribute.lower() in KEYWORDS:
+			raise ValueError('expected clinical attribute but found "' + str(attribute) + '"')
+
+		negate = False
+		if self.is_keyword('not'):
+			self.next()
+			negate = True
+			if not self.is_keyword('in'):
+				raise ValueError('expected "in" after "' + attribute + ' not"')
+		if self.is_keyword('in'):
+			self.next()
+			self.expect('(')
+			values = [self.parse_value()]
+			while self.peek() == ('op', ','):
+				self.next()
+				values.append(self.parse_value())
+			self.expect(')')
+			node = ('in', attribute, values)
+			if negate:
+				return ('not', node)
+			return node
+
+		kind,operator = self.next()
+		if kind != 'op' or operator not in COMPARISON_OPERATORS:
+			raise ValueError('expected comparison operator after "' + attribute + '" but found "' + str(operator) + '"')
+		return ('compare', attribute, operator, self.parse_value())
+
+	def parse_value(self):
+		kind,value = self.next()
+		if kind not in ['word', 'value']:
+			raise ValueError('expected value but found "' + value + '"')
+		return value
+
+
+def compile_predicate(predicate):
+	""" Parses the predicate into a tree that can be evaluated over clinical attribute columns. """
+	return PredicateParser(predicate).parse()
+
+
+def get_predicate_attributes(node):
+	""" Returns the clinical attributes used in the compiled predicate. """
+	if node[0] in ['and', 'or']:
+		attributes = []
+		for child in node[1]:
+			attributes.extend([attribute for attribute in get_predicate_attributes(child) if attribute not in attributes])
+		return attributes
+	elif node[0] == 'not':
+		return get_predicate_attributes(node[1])
+	return [node[1]]
+
+
+def to_number(value):
+	""" Returns the value as a float, or None if it is not a number. """
+	try:
+		return float(value)
+	except ValueError:
+		return None
+
+
+def compare_column(column, operator, value):
+	"""
+		Compares every value of the column to the given value and returns the list of results.
+		Ordering comparisons are numeric and are false for non-numeric values (i.e., NA).
+		Equality is numeric if both values are numbers and a string comparison otherwise.
+	"""
+	number = to_number(value)
+	if operator in ['<', '<=', '>', '>=']:
+		if number == None:
+			raise ValueError('expected a number to compare with "' + operator + '" but found "' + value + '"')
+		numbers = map(to_number, column)
+		if operator == '<':
+			return [x != None and x < number for x in numbers]
+		elif operator == '<=':
+			return [x != None and x <= number for x in numbers]
+		elif operator == '>':
+			return [x != None and x > number for x in numbers]
+		return [x != None and x >= number for x in numbers]
+
+	if number == None:
+		matches = [x == value for x in column]
+	else:
+		matches = [x == value or to_number(x) == number for x in column]
+	if operator == '!=':
+		return [not x for x in matches]
+	return matches
+
+
+def evaluate_predicate(node, columns):
+	"""
+		Evaluates the compiled predicate over clinical attribute columns (attribute -> list of values)
+		one column operation at a time and returns the list of whether each row matches.
+	"""
+	if node[0] == 'and':
+		matches = evaluate_predicate(node[1][0], columns)
+		for child in node[1][1:]:
+			matches = [x and y for x,y in zip(matches, evaluate_predicate(child, columns))]
+		return matches
+	elif node[0] == 'or':
+		matches = evaluate_predicate(node[1][0], columns)
+		for child in node[1][1:]:
+			matches = [x or y for x,y in zip(matches, evaluate_predicate(child, columns))]
+		return matches
+	elif node[0] == 'not':
+		return [not x for x in evaluate_predicate(node[1], columns)]
+	elif node[0] == 'in':
+		values = set(node[2])
+		return [x in values for x in columns[node[1]]]
+	return compare_column(columns[node[1]], node[2], node[3])